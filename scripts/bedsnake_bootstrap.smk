@@ -28,6 +28,10 @@ if not BIOTYPES:
 DOMAINS = ["Archaea", "Bacteria", "Eukaryota", "Viruses"]
 # DOMAINS = ["Bacteria"]
 SITES = ["TSS", "TES"]
+# every window size of a (multi-window) enrichment sweep is bootstrapped separately; `bootstrap_window_size` restricts the sweep
+WINDOW_SIZES = config.get('bootstrap_window_size', config['window_size'])
+WINDOW_SIZES = WINDOW_SIZES if isinstance(WINDOW_SIZES, list) else [WINDOW_SIZES]
+WINDOW_SIZES = sorted({int(window_size) for window_size in WINDOW_SIZES}, reverse=True)
 # <<
 
 # create directories
@@ -38,63 +42,139 @@ dest_dir_phylum.mkdir(exist_ok=True)
 
 print(f"CHOSEN MODE: `{mode}`.")
 print(f"Biotypes: `{BIOTYPES}`.")
+print(f"Window sizes: `{WINDOW_SIZES}`.")
 print(f"Redirecting domain level outputs to --> `{dest_dir_domain}`.")
 print(f"Redirecting phylum level outputs to --> `{dest_dir_phylum}`.")
 # <<
 
+wildcard_constraints:
+    window=r"\d+"
 
 rule all:
     input:
-        expand(['%s/%s/enrichment/domain/enrichment_bootstrap_alpha_%s.{site}.%s.domain.{domain}.csv' % (out, mode, alpha, mode),
-               '%s/%s/enrichment/domain/enrichment_phylums.{site}.%s.{domain}.csv' % (out, mode, mode)], 
-                                 site=SITES, domain=DOMAINS),
-        expand(['%s/%s/enrichment/phylum/enrichment_bootstrap_alpha_%s.{site}.%s.phylum.{phylum}.csv' % (out, mode, alpha, mode)], site=SITES, phylum=PHYLUMS),
+        expand(['%s/%s/enrichment/domain/enrichment_bootstrap_alpha_%s.{site}.w{window}.%s.domain.{domain}.csv' % (out, mode, alpha, mode),
+               '%s/%s/enrichment/domain/enrichment_phylums.{site}.w{window}.%s.{domain}.csv' % (out, mode, mode)], 
+                                 site=SITES, window=WINDOW_SIZES, domain=DOMAINS),
+        expand(['%s/%s/enrichment/phylum/enrichment_bootstrap_alpha_%s.{site}.w{window}.%s.phylum.{phylum}.csv' % (out, mode, alpha, mode)], site=SITES, window=WINDOW_SIZES, phylum=PHYLUMS),
 
-rule taxonomyDomainBootstrap:
+# summed profiles of every rank, built once per site & window size; the phylum averages of every domain are slices of it
+rule rankRollup:
     input:
         DESIGN,
         '%s/%s/enrichment/enrichment_compartments.{site}.%s.parquet' % (out, mode, mode),
     output:
-        '%s/%s/enrichment/domain/enrichment_bootstrap_alpha_%s.{site}.%s.domain.{domain}.csv' % (out, mode, alpha, mode),
-        '%s/%s/enrichment/domain/enrichment_phylums.{site}.%s.{domain}.csv' % (out, mode, mode)
+        '%s/%s/enrichment/enrichment_rollup.{site}.w{window}.%s.parquet' % (out, mode, mode),
     params:
-        window_size=int(config['window_size']),
+        window_size=lambda wildcards: int(wildcards.window),
         alpha=round(float(config['alpha']), 2),
-        mode=config['mode'],
         N=int(config['N']),
+        seed=config.get('seed'),
         join_templates=config['join_templates']
     run:
         bootstrapper = Bootstrapper(design=input[0], enrichment_file=input[1], params=params)
-        if params.mode == "template":
-            bootstrapper.bootstrap_enrichment(taxonomic_rank="superkingdom", 
-                                              rank=wildcards.domain, 
-                                              output=output[0])
-        else:
-            bootstrapper.bootstrap_enrichment_density(taxonomic_rank="superkingdom", 
-                                                      rank=wildcards.domain, 
-                                                      output=output[0])
-        bootstrapper.average_phylums(domain=wildcards.domain, 
-                                     output=output[1],
-                                     join_templates=params.join_templates)
+        bootstrapper.rank_rollup(join_templates=params.join_templates, output=output[0])
 
-rule taxonomyPhylumBootstrap:
-    input:
-        DESIGN,
-        '%s/%s/enrichment/enrichment_compartments.{site}.%s.parquet' % (out, mode, mode),
-    output:
-        '%s/%s/enrichment/phylum/enrichment_bootstrap_alpha_%s.{site}.%s.phylum.{phylum}.csv' % (out, mode, alpha, mode),
-    params:
-        window_size=int(config['window_size']),
-        alpha=round(float(config['alpha']), 2),
-        N=int(config['N']),
-        mode=config['mode'],
-    run:
-        bootstrapper = Bootstrapper(design=input[0], enrichment_file=input[1], params=params)
-        if params.mode == "template":
-            bootstrapper.bootstrap_enrichment(taxonomic_rank="phylum", 
-                                              rank=wildcards.phylum.replace('-', ' '), 
-                                              output=output[0])
-        else:
-            bootstrapper.bootstrap_enrichment_density(taxonomic_rank="phylum", 
-                                                      rank=wildcards.phylum.replace('-', ' '), 
-                                                      output=output[0])
+# a single job per site loads the enrichment table once & bootstraps every domain and phylum
+BATCH = int(config.get('batch', 1))
+
+if BATCH:
+    rule taxonomyBootstrap:
+        input:
+            DESIGN,
+            '%s/%s/enrichment/enrichment_compartments.{site}.%s.parquet' % (out, mode, mode),
+            '%s/%s/enrichment/enrichment_rollup.{site}.w{window}.%s.parquet' % (out, mode, mode),
+        output:
+            domains=expand('%s/%s/enrichment/domain/enrichment_bootstrap_alpha_%s.{{site}}.w{{window}}.%s.domain.{domain}.csv' % (out, mode, alpha, mode), domain=DOMAINS),
+            phylum_averages=expand('%s/%s/enrichment/domain/enrichment_phylums.{{site}}.w{{window}}.%s.{domain}.csv' % (out, mode, mode), domain=DOMAINS),
+            phylums=expand('%s/%s/enrichment/phylum/enrichment_bootstrap_alpha_%s.{{site}}.w{{window}}.%s.phylum.{phylum}.csv' % (out, mode, alpha, mode), phylum=PHYLUMS),
+        params:
+            window_size=lambda wildcards: int(wildcards.window),
+            alpha=round(float(config['alpha']), 2),
+            mode=config['mode'],
+            N=int(config['N']),
+            seed=config.get('seed'),
+            adaptive=int(config.get('adaptive', 0)),
+            min_N=int(config.get('min_N', 200)),
+            tolerance=float(config.get('tolerance', 5e-3)),
+            patience=int(config.get('patience', 3)),
+            join_templates=config['join_templates']
+        threads: int(config.get('threads', 1))
+        run:
+            bootstrapper = Bootstrapper(design=input[0], enrichment_file=input[1], params=params, workers=threads)
+            # one pool of resampling processes serves every domain & phylum of the site
+            with bootstrapper.worker_pool():
+                bootstrapper.bootstrap_ranks(taxonomic_rank="superkingdom",
+                                             outputs=dict(zip(DOMAINS, output.domains)),
+                                             mode=params.mode)
+                for domain, phylum_output in zip(DOMAINS, output.phylum_averages):
+                    bootstrapper.average_phylums(domain=domain, 
+                                                 output=phylum_output,
+                                                 join_templates=params.join_templates,
+                                                 rollup_file=input[2])
+                bootstrapper.bootstrap_ranks(taxonomic_rank="phylum",
+                                             outputs={phylum.replace('-', ' '): phylum_output for phylum, phylum_output in zip(PHYLUMS, output.phylums)},
+                                             mode=params.mode)
+
+else:
+    rule taxonomyDomainBootstrap:
+        input:
+            DESIGN,
+            '%s/%s/enrichment/enrichment_compartments.{site}.%s.parquet' % (out, mode, mode),
+            '%s/%s/enrichment/enrichment_rollup.{site}.w{window}.%s.parquet' % (out, mode, mode),
+        output:
+            '%s/%s/enrichment/domain/enrichment_bootstrap_alpha_%s.{site}.w{window}.%s.domain.{domain}.csv' % (out, mode, alpha, mode),
+            '%s/%s/enrichment/domain/enrichment_phylums.{site}.w{window}.%s.{domain}.csv' % (out, mode, mode)
+        params:
+            window_size=lambda wildcards: int(wildcards.window),
+            alpha=round(float(config['alpha']), 2),
+            mode=config['mode'],
+            N=int(config['N']),
+            seed=config.get('seed'),
+            adaptive=int(config.get('adaptive', 0)),
+            min_N=int(config.get('min_N', 200)),
+            tolerance=float(config.get('tolerance', 5e-3)),
+            patience=int(config.get('patience', 3)),
+            join_templates=config['join_templates']
+        threads: int(config.get('threads', 1))
+        run:
+            bootstrapper = Bootstrapper(design=input[0], enrichment_file=input[1], params=params, workers=threads)
+            if params.mode == "template":
+                bootstrapper.bootstrap_enrichment(taxonomic_rank="superkingdom", 
+                                                  rank=wildcards.domain, 
+                                                  output=output[0])
+            else:
+                bootstrapper.bootstrap_enrichment_density(taxonomic_rank="superkingdom", 
+                                                          rank=wildcards.domain, 
+                                                          output=output[0])
+            bootstrapper.average_phylums(domain=wildcards.domain, 
+                                         output=output[1],
+                                         join_templates=params.join_templates,
+                                         rollup_file=input[2])
+
+    rule taxonomyPhylumBootstrap:
+        input:
+            DESIGN,
+            '%s/%s/enrichment/enrichment_compartments.{site}.%s.parquet' % (out, mode, mode),
+        output:
+            '%s/%s/enrichment/phylum/enrichment_bootstrap_alpha_%s.{site}.w{window}.%s.phylum.{phylum}.csv' % (out, mode, alpha, mode),
+        params:
+            window_size=lambda wildcards: int(wildcards.window),
+            alpha=round(float(config['alpha']), 2),
+            N=int(config['N']),
+            seed=config.get('seed'),
+            adaptive=int(config.get('adaptive', 0)),
+            min_N=int(config.get('min_N', 200)),
+            tolerance=float(config.get('tolerance', 5e-3)),
+            patience=int(config.get('patience', 3)),
+            mode=config['mode'],
+        threads: int(config.get('threads', 1))
+        run:
+            bootstrapper = Bootstrapper(design=input[0], enrichment_file=input[1], params=params, workers=threads)
+            if params.mode == "template":
+                bootstrapper.bootstrap_enrichment(taxonomic_rank="phylum", 
+                                                  rank=wildcards.phylum.replace('-', ' '), 
+                                                  output=output[0])
+            else:
+                bootstrapper.bootstrap_enrichment_density(taxonomic_rank="phylum", 
+                                                          rank=wildcards.phylum.replace('-', ' '), 
+                                                          output=output[0])
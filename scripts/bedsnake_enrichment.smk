@@ -14,13 +14,13 @@ import tempfile
 import json
 import pybedtools
 from pybedtools import BedTool
-from utils import ProgressTracker
+from utils import ProgressTracker, BucketCheckpoint, stream_enrichment_buckets, stream_query_buckets, write_enrichment_bucket
 import numpy as np
 import pandas as pd
 from collections import defaultdict
 from mindi.scheduling import MiniBucketScheduler
-from mindi.coverage.density import extract_density
-from mindi.coverage.pwm_density import strand_evaluators
+from mindi.coverage.density import extract_density, extract_grouped_density, AccessionContext
+from mindi.coverage.pwm_density import strand_evaluators, PWMExtractor
 from mindi.coverage.utils import INTERSECT_FIELDS
 
 out = Path(config['out']).resolve()
@@ -29,6 +29,25 @@ TOTAL_BUCKETS = int(config['buckets'])
 mode = config['mode']
 alpha = round(float(config['alpha']), 2)
 DESIGN = config['DESIGN']
+# a list of window sizes is resolved from one intersection at the largest window
+WINDOW_SIZES = config['window_size'] if isinstance(config['window_size'], list) else [config['window_size']]
+WINDOW_SIZES = sorted({int(window_size) for window_size in WINDOW_SIZES}, reverse=True)
+# profiles are aggregated into bins of `BIN_SIZE` positions, one of them centred on the site (1: full resolution); edge positions that do not fill a bin are dropped
+BIN_SIZE = int(config.get('bin_size', 1))
+# enrichment tables are sorted on the taxonomy & written in row groups of `ROW_GROUP_SIZE` rows
+TAXONOMIC_RANKS = ["superkingdom", "kingdom", "phylum"]
+ROW_GROUP_SIZE = int(config.get('row_group_size', 10_000))
+# arrow buckets hold narrow integer profiles with dictionary-encoded keys and are memory-mapped by the reduce step
+BUCKET_FORMAT = config.get('bucket_format', 'arrow')
+if BUCKET_FORMAT not in {"arrow", "csv"}:
+    raise ValueError(f"Invalid bucket format `{BUCKET_FORMAT}`. Choose between `arrow` and `csv`.")
+BUCKET_SUFFIX = "enrichment.arrow" if BUCKET_FORMAT == "arrow" else "enrichment"
+# zstd (default) or lz4 compression of arrow buckets; `none` writes buckets that are read without decompression
+BUCKET_COMPRESSION = config.get('bucket_compression', 'zstd')
+if BUCKET_COMPRESSION in {None, "none"}:
+    BUCKET_COMPRESSION = None
+elif BUCKET_COMPRESSION not in {"zstd", "lz4"}:
+    raise ValueError(f"Invalid bucket compression `{BUCKET_COMPRESSION}`. Choose between `zstd`, `lz4` and `none`.")
 
 tempdir = Path(config['tempdir']).resolve()
 tempdir.mkdir(exist_ok=True)
@@ -81,7 +100,7 @@ rule extractEnrichment:
          DESIGN, 
          '%s/schedule_enrichment_%s.json' % (out, TOTAL_BUCKETS)
     output:
-        '%s/%s/enrichment/enrichment_compartments_bucket_{bucket}.%s.enrichment' % (out, mode, mode),
+        '%s/%s/enrichment/enrichment_compartments_bucket_{bucket}.%s.%s' % (out, mode, mode, BUCKET_SUFFIX),
         '%s/%s/enrichment/queries_compartments_bucket_{bucket}.%s.queries' % (out, mode, mode)
     params:
         out=Path(config['out']).resolve(),
@@ -89,11 +108,14 @@ rule extractEnrichment:
         compartment=config['compartment'],
         split_category=config['split_category'],
         split_collection=config['split_collection'],
-        window_size=int(config["window_size"]),
+        window_size=WINDOW_SIZES[0],
+        window_sizes=WINDOW_SIZES,
+        bin_size=BIN_SIZE,
         sleeping_time=config['log_sleep'],
         mode=config["mode"],
         biotypes=config['biotypes'],
         strand_evaluator=config['strand_evaluator'],
+        grouped=int(config.get('grouped', 1)),
         # bedtools_path=config['bedtools_path'],
     run:
         print(f"Initializing bucket {wildcards.bucket} enrichment extraction process for compartment {params.compartment} and window length {params.window_size}.")
@@ -114,6 +136,12 @@ rule extractEnrichment:
             split_category_collection += [int(col) for col in params.split_collection]
         if not params.split_category:
             params.split_category = 'partition'
+        multi_window = len(params.window_sizes) > 1
+        if multi_window and not params.grouped:
+            raise ValueError(f"Multiple window sizes {params.window_sizes} are only supported in grouped mode.")
+        if params.bin_size > 1 and not params.grouped:
+            raise ValueError(f"Binned profiles (bin size {params.bin_size}) are only supported in grouped mode.")
+        positions = PWMExtractor.profile_positions(params.window_size, params.bin_size)
 
         total_accessions = len(accessions)
 
@@ -129,18 +157,52 @@ rule extractEnrichment:
         # << LOGGING INITIALIZATION
 
         # >> extraction initializes
-        enrichment_table = []
-        queries_table = []
         invalid_entries = []
         if len(params.biotypes) == 0:
           biotypes = [None]
         else:
           biotypes = params.biotypes
 
-        for gff_file in accessions:
-            tracker.counter += 1
+        def extract_accession(gff_file: str) -> tuple[list[pd.DataFrame], list[pd.DataFrame]]:
+            enrichment_parts, queries_parts = [], []
             print(colored(f"Processing accession '{gff_file}'.", "green"))
             accession_id, extraction_file = file_ids[gff_file]
+            # parse extraction & GFF once; every (biotype, attribute) combination is served from memory
+            context = AccessionContext(extraction=extraction_file, gff_file=gff_file)
+
+            if params.grouped:
+                # intersect once; one profile per (site, biotype, partition) group
+                print(f"Bucket {wildcards.bucket}; Processing {biotypes=};{params.split_category}={split_category_collection}...")
+                query_result = extract_grouped_density(
+                                                context=context,
+                                                window_size=params.window_sizes if multi_window else params.window_size,
+                                                compartment=params.compartment,
+                                                biotypes=biotypes,
+                                                determine_strand=strand_evaluators[params.strand_evaluator],
+                                                attribute_col=params.split_category,
+                                                attributes=split_category_collection,
+                                                enrichment=False,
+                                                mode=params.mode,
+                                                bin_size=params.bin_size
+                                                )
+                if query_result is None:
+                    print(colored(f"Query failed when querying `{gff_file}` GFF.\nThe calculation won't be completed.\nReasons: Empty extraction or empty GFF file.", "red"))
+                    invalid_entries.append(extraction_file)
+                    return enrichment_parts, queries_parts
+                vector_counts, queries = query_result
+                vector_counts.loc[:, "#assembly_accession"] = accession_id
+                queries.loc[:, "#assembly_accession"] = accession_id
+                key_columns = ["template|non_template"] if params.mode == "template" else []
+                if multi_window:
+                    key_columns.append("window_size")
+                vector_counts = vector_counts[["#assembly_accession"] + key_columns + [
+                                               "site",
+                                               "biotype",
+                                               params.split_category,
+                                               ] + positions]
+                enrichment_parts.append(vector_counts)
+                queries_parts.append(queries)
+                return enrichment_parts, queries_parts
 
             for biotype in biotypes:
                 for attribute in split_category_collection:
@@ -156,7 +218,8 @@ rule extractEnrichment:
 						                        tempdir=tempdir,
                                                 attribute=attribute,
                                                 enrichment=False,
-                                                mode=params.mode
+                                                mode=params.mode,
+                                                context=context
                                                 )
                     if query_result is None:
                         print(colored(f"Query failed for {biotype=} and {attribute=} when querying `{gff_file}` GFF.\nThe calculation won't be completed.\nReasons: Empty extraction or empty GFF file.", "red"))
@@ -179,13 +242,39 @@ rule extractEnrichment:
                                                    "site",
                                                    "biotype",
                                                    params.split_category,
-                                                   ] + list(range(-params.window_size, params.window_size+1))]
+                                                   ] + positions]
                     if params.mode == "template":
                         vector_counts = vector_counts.reset_index()\
                                                      .rename(columns={"index": "template|non_template"})
-                    enrichment_table.append(vector_counts)
+                    enrichment_parts.append(vector_counts)
                     print(vector_counts)
-                    queries_table.append(queries)
+                    queries_parts.append(queries)
+            return enrichment_parts, queries_parts
+
+        # finished accessions are checkpointed; a rerun of a killed job resumes after them
+        checkpoint = BucketCheckpoint(output[0], signature={
+                                                    "mode": params.mode,
+                                                    "compartment": params.compartment,
+                                                    "biotypes": biotypes,
+                                                    "split_category": params.split_category,
+                                                    "split_collection": split_category_collection,
+                                                    "window_sizes": params.window_sizes,
+                                                    "bin_size": params.bin_size,
+                                                    "grouped": params.grouped,
+                                                    "strand_evaluator": params.strand_evaluator,
+                                                    })
+        for gff_file in accessions:
+            tracker.counter += 1
+            if checkpoint.done(gff_file):
+                print(colored(f"Accession '{gff_file}' was restored from the bucket checkpoint.", "blue"))
+                continue
+            enrichment_parts, queries_parts = extract_accession(gff_file)
+            checkpoint.save(gff_file, {
+                                "enrichment": pd.concat(enrichment_parts, axis=0) if enrichment_parts else None,
+                                "queries": pd.concat(queries_parts, axis=0) if queries_parts else None,
+                                })
+        enrichment_table = [table.to_pandas() for table in checkpoint.load("enrichment", accessions)]
+        queries_table = [table.to_pandas() for table in checkpoint.load("queries", accessions)]
         # << extraction finished
         
         # >> save results
@@ -212,22 +301,27 @@ rule extractEnrichment:
                                                          "site",
                                                          "biotype",
                                                          params.split_category,
-                                                         "nucleotide"] + list(range(-params.window_size, params.window_size+1))
+                                                         "nucleotide"] + positions
                                             )
         pybedtools.helpers.cleanup(remove_all=False)
         # save enrichment table
         enrichment_table.set_index("#assembly_accession", inplace=True)
-        enrichment_table.to_csv(output[0], sep=",", index=True, mode="w")
+        if BUCKET_FORMAT == "arrow":
+            write_enrichment_bucket(enrichment_table, output[0], compression=BUCKET_COMPRESSION)
+        else:
+            enrichment_table.to_csv(output[0], sep=",", index=True, mode="w")
 
         # save queries table 
         queries_table.set_index("#assembly_accession", inplace=True)
         queries_table.to_csv(output[1], sep=",", index=True, mode="w")
+        checkpoint.cleanup()
         # << save results finished
 
 rule reduceEnrichment:
     input:
+        DESIGN,
         expand([
-               '%s/%s/enrichment/enrichment_compartments_bucket_{bucket}.%s.enrichment' % (out, mode, mode),
+               '%s/%s/enrichment/enrichment_compartments_bucket_{bucket}.%s.%s' % (out, mode, mode, BUCKET_SUFFIX),
                '%s/%s/enrichment/queries_compartments_bucket_{bucket}.%s.queries' % (out, mode, mode)
                ],
                bucket=range(TOTAL_BUCKETS))
@@ -238,28 +332,22 @@ rule reduceEnrichment:
         '%s/%s/enrichment/queries_compartments.TES.%s.csv' % (out, mode, mode),
     run:
         # enrichment
-        enrichment_table = []
-        for bucket in range(TOTAL_BUCKETS):
-            coverage_file = f"{out}/{mode}/enrichment/enrichment_compartments_bucket_{bucket}.{mode}.enrichment"
-            coverage_df = pd.read_csv(coverage_file)
-            enrichment_table.append(coverage_df)
-        enrichment_table = pd.concat(enrichment_table, axis=0)
-        enrichment_table.set_index("#assembly_accession", inplace=True)
-        enrichment_table_TSS = enrichment_table[enrichment_table['site'] == 'tss'].drop(columns=['site'])
-        enrichment_table_TES = enrichment_table[enrichment_table['site'] == 'tes'].drop(columns=['site'])
-        # save enrichment table
-        enrichment_table_TSS.to_parquet(output[0], engine="fastparquet")
-        enrichment_table_TES.to_parquet(output[1], engine="fastparquet")
+        # buckets are streamed into one taxonomy-sorted parquet per site; memory is bounded by a parsed block per sorted run
+        # record the profile resolution so that downstream steps can label the positions
+        profile_metadata = {"window_size": str(WINDOW_SIZES[0]),
+                            "bin_size": str(BIN_SIZE),
+                            "bin_edges": json.dumps({window_size: PWMExtractor.profile_bins(window_size, BIN_SIZE) for window_size in WINDOW_SIZES})}
+        stream_enrichment_buckets(
+                                 [f"{out}/{mode}/enrichment/enrichment_compartments_bucket_{bucket}.{mode}.{BUCKET_SUFFIX}" for bucket in range(TOTAL_BUCKETS)],
+                                 outputs={"TSS": output[0], "TES": output[1]},
+                                 design=DESIGN,
+                                 taxonomic_ranks=TAXONOMIC_RANKS,
+                                 metadata=profile_metadata,
+                                 row_group_size=ROW_GROUP_SIZE,
+                                 tempdir=tempdir
+                                 )
         # queries
-        queries_table = []
-        for bucket in range(TOTAL_BUCKETS):
-            coverage_file = f"{out}/{mode}/enrichment/queries_compartments_bucket_{bucket}.{mode}.queries"
-            coverage_df = pd.read_csv(coverage_file)
-            queries_table.append(coverage_df)
-        queries_table = pd.concat(queries_table, axis=0)
-        queries_table.set_index("#assembly_accession", inplace=True)
-        queries_table_TSS = queries_table[queries_table['site'] == 'tss'].drop(columns=['site'])
-        queries_table_TES = queries_table[queries_table['site'] == 'tes'].drop(columns=['site'])
-        # save query table
-        queries_table_TSS.to_csv(output[2], sep=",", index=True, mode="w")
-        queries_table_TES.to_csv(output[3], sep=",", index=True, mode="w")
+        stream_query_buckets(
+                            [f"{out}/{mode}/enrichment/queries_compartments_bucket_{bucket}.{mode}.queries" for bucket in range(TOTAL_BUCKETS)],
+                            outputs={"TSS": output[2], "TES": output[3]}
+                            )
@@ -0,0 +1,77 @@
+import time
+import numpy as np
+import pandas as pd
+from termcolor import colored
+
+from mindi.coverage.pwm_density import PWMExtractor
+
+def simulate_intersect(total_hits: int,
+                       window_size: int = 500,
+                       max_motif_length: int = 60,
+                       seed: int = 42) -> pd.DataFrame:
+    """Simulates an intersect table of TSS windows against motifs, as produced by `density.query`."""
+    rng = np.random.default_rng(seed)
+    loci = rng.integers(window_size + max_motif_length, 10_000_000, size=total_hits)
+    start = loci - window_size
+    end = loci + window_size + 1
+    motif_length = rng.integers(10, max_motif_length, size=total_hits)
+    motif_start = rng.integers(start - motif_length + 1, end)
+    motif_end = motif_start + motif_length
+    overlap = np.minimum(motif_end, end) - np.maximum(motif_start, start)
+    sequence = ["".join(rng.choice(list("agct"), size=length)) for length in motif_length]
+    return pd.DataFrame({
+                        "seqID": "chr1",
+                        "start": start,
+                        "end": end,
+                        "strand": rng.choice(["+", "-"], size=total_hits),
+                        "chrom": "chr1",
+                        "motif_start": motif_start,
+                        "motif_end": motif_end,
+                        "sequence": sequence,
+                        "motif_strand": rng.choice(["+", "-"], size=total_hits),
+                        "overlap": overlap,
+                        })
+
+def benchmark(function, *args, repeats: int = 3, **kwargs) -> tuple[float, object]:
+    timings = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings.append(time.perf_counter() - t0)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="""Benchmarks the iterative against the vectorized profile extraction.""")
+    parser.add_argument("--hits", type=int, default=100_000)
+    parser.add_argument("--window_size", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    intersect_df = simulate_intersect(args.hits, window_size=args.window_size)
+    extractor = PWMExtractor()
+
+    print(colored(f"Benchmarking `extract_density` on {args.hits} intersections (window size {args.window_size}).", "blue"))
+    t_loop, loop_counts = benchmark(extractor.extract_density, intersect_df,
+                                    window_size=args.window_size, vectorized=False, repeats=1)
+    t_vec, vec_counts = benchmark(extractor.extract_density, intersect_df,
+                                  window_size=args.window_size, vectorized=True, repeats=args.repeats)
+    assert np.array_equal(loop_counts, vec_counts), "Vectorized profile differs from the iterative profile."
+    print(f"Iterative: {t_loop:.3f}s; Vectorized: {t_vec:.4f}s; Speedup: {t_loop / t_vec:.1f}x.")
+
+    print(colored(f"Benchmarking `extract_template_density` on {args.hits} intersections (window size {args.window_size}).", "blue"))
+    t_loop, loop_template = benchmark(extractor.extract_template_density, intersect_df,
+                                      window_size=args.window_size, vectorized=False, repeats=1)
+    t_vec, vec_template = benchmark(extractor.extract_template_density, intersect_df,
+                                    window_size=args.window_size, vectorized=True, repeats=args.repeats)
+    pd.testing.assert_frame_equal(loop_template, vec_template)
+    print(f"Iterative: {t_loop:.3f}s; Vectorized: {t_vec:.4f}s; Speedup: {t_loop / t_vec:.1f}x.")
+
+    print(colored(f"Benchmarking `extract_PWM` on {args.hits} intersections (window size {args.window_size}).", "blue"))
+    t_loop, loop_pwm = benchmark(extractor.extract_PWM, intersect_df,
+                                 window_size=args.window_size, vectorized=False, repeats=1)
+    t_vec, vec_pwm = benchmark(extractor.extract_PWM, intersect_df,
+                               window_size=args.window_size, vectorized=True, repeats=args.repeats)
+    assert loop_pwm == vec_pwm, "Vectorized nucleotide composition differs from the iterative composition."
+    print(f"Iterative: {t_loop:.3f}s; Vectorized: {t_vec:.4f}s; Speedup: {t_loop / t_vec:.1f}x.")
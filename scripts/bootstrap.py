@@ -1,31 +1,313 @@
+import sys
+import warnings
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import multiprocessing
+from multiprocessing import shared_memory
+from scipy import sparse
+from typing import Optional
 
-def confidence_interval_bootstrap(df, alpha=0.95, total_resamples = 5000):
+# matrix shared by the resampling workers; populated by `_attach_matrix`
+_shared = {}
+
+def _share_matrix(matrix) -> tuple[list[shared_memory.SharedMemory], list[tuple], Optional[tuple]]:
+    """Copies the dense (or CSR) matrix buffers once into shared memory."""
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix)
+        arrays, sparse_shape = [matrix.data, matrix.indices, matrix.indptr], matrix.shape
+    else:
+        arrays, sparse_shape = [np.ascontiguousarray(matrix)], None
+    handles, specs = [], []
+    for array in arrays:
+        handle = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=handle.buf)[...] = array
+        handles.append(handle)
+        specs.append((handle.name, array.shape, array.dtype.str))
+    return handles, specs, sparse_shape
+
+def _attach_segment(name: str) -> shared_memory.SharedMemory:
+    """Attaches a segment owned by the parent, which alone unlinks it."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching registers the segment again; spawned workers share the resource tracker
+    # of the parent, so the registration is the parent's own and is dropped by its unlink
+    return shared_memory.SharedMemory(name=name)
+
+def _attach_matrix(specs: list[tuple], sparse_shape: Optional[tuple]) -> None:
+    if _shared.get("specs") == specs:
+        return
+    for handle in _shared.get("handles", []):
+        handle.close()
+    handles = [_attach_segment(name) for name, _, _ in specs]
+    arrays = []
+    for handle, (_, shape, dtype) in zip(handles, specs):
+        array = np.ndarray(shape, dtype=dtype, buffer=handle.buf)
+        array.flags.writeable = False
+        arrays.append(array)
+    if sparse_shape is None:
+        matrix = arrays[0]
+    else:
+        matrix = sparse.csr_matrix(tuple(arrays), shape=sparse_shape, copy=False)
+    _shared.update(matrix=matrix, handles=handles, specs=specs)
+
+def _resample(matrix,
+              total_resamples: int,
+              rng: np.random.Generator,
+              cumulative: bool = False,
+              max_elements: int = 2**24) -> np.ndarray:
+    """Draws `total_resamples` mean-normalized resampled column sums of `matrix`."""
+    total_rows = matrix.shape[0]
+    # bound the memory of the (chunk x rows) weights matrix
+    chunksize = max(1, min(total_resamples, max_elements // max(total_rows, 1)))
+    pvals = np.full(total_rows, 1 / total_rows) if total_rows > 0 else None
+    samples = []
+    for chunk_start in range(0, total_resamples, chunksize):
+        size = min(chunksize, total_resamples - chunk_start)
+        if total_rows > 0:
+            weights = rng.multinomial(total_rows, pvals, size=size)
+        else:
+            weights = np.zeros((size, 0), dtype=np.int64)
+        resampled = np.asarray(matrix.T @ weights.T, dtype=float).T
+        if cumulative:
+            resampled = np.cumsum(resampled, axis=1)[:, :-1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            resampled = resampled / resampled.mean(axis=1, keepdims=True)
+        samples.append(resampled)
+    return np.concatenate(samples, axis=0)
+
+def _resample_shared(specs: list[tuple],
+                     sparse_shape: Optional[tuple],
+                     total_resamples: int,
+                     rng: np.random.Generator,
+                     cumulative: bool,
+                     max_elements: int) -> np.ndarray:
+    # a pooled worker attaches once to every matrix it is handed
+    _attach_matrix(specs, sparse_shape)
+    return _resample(_shared["matrix"], total_resamples, rng, cumulative, max_elements)
+
+class BootstrapPool:
+    """Resampling processes shared by successive bootstraps.
+
+    Starting the workers is paid once; every bootstrap run on the pool only copies its matrix
+    into shared memory, which the workers attach to on their first block.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        # spawned, not forked from a process already running pyarrow / BLAS threads
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __enter__(self) -> "BootstrapPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+@contextmanager
+def _block_sampler(matrix, 
+                   workers: int = 1, 
+                   cumulative: bool = False, 
+                   max_elements: int = 2**24,
+                   pool: Optional[BootstrapPool] = None):
+    """Yields a function lazily drawing the resamples of a list of blocks, either serially or on a pool of processes.
+
+    Without a `pool`, one is started for `workers` > 1 and shut down afterwards.
+    """
+    if pool is None and workers <= 1:
+        yield lambda block_sizes, block_rngs: (_resample(matrix, size, block_rng, cumulative, max_elements)
+                                               for size, block_rng in zip(block_sizes, block_rngs))
+        return
+    owned = pool is None
+    if owned:
+        pool = BootstrapPool(workers)
+    handles, specs, sparse_shape = _share_matrix(matrix)
+    try:
+        yield lambda block_sizes, block_rngs: pool.executor.map(_resample_shared,
+                                                                [specs] * len(block_sizes),
+                                                                [sparse_shape] * len(block_sizes),
+                                                                block_sizes,
+                                                                block_rngs,
+                                                                [cumulative] * len(block_sizes),
+                                                                [max_elements] * len(block_sizes))
+    finally:
+        if owned:
+            pool.close()
+        for handle in handles:
+            handle.close()
+            handle.unlink()
+
+def _summarize(samples: np.ndarray, 
+               lower_q: float, 
+               upper_q: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    with warnings.catch_warnings():
+        # empty tables yield all-NaN profiles, as with the resampled pandas frames
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(samples, axis=0), np.nanquantile(samples, lower_q, axis=0), np.nanquantile(samples, upper_q, axis=0)
+
+class _StreamingQuantiles:
+    """Exact running mean & linear-interpolated quantiles per column of up to N streamed rows.
+
+    Only the order statistics the interpolation can reach are kept: the smallest rows for the lower
+    and the largest rows for the upper quantile, so memory grows with the tails instead of with N.
+    Rows holding NaN (resamples with an empty profile) are skipped, as `np.nanquantile` would.
+    """
+
+    def __init__(self, N: int, lower_q: float, upper_q: float, total_columns: int) -> None:
+        self.lower_q = lower_q
+        self.upper_q = upper_q
+        # order statistics k & k+1 around the virtual index q * (N-1); one extra row as margin
+        self.total_lower = min(N, int(np.floor(lower_q * (N - 1))) + 2)
+        self.total_upper = min(N, N - int(np.floor(upper_q * (N - 1))) + 1)
+        self.lower = np.empty((0, total_columns))
+        self.upper = np.empty((0, total_columns))
+        self.total = np.zeros(total_columns)
+        self.count = 0
+
+    def update(self, samples: np.ndarray) -> None:
+        samples = samples[~np.isnan(samples).any(axis=1)]
+        self.total += samples.sum(axis=0)
+        self.count += samples.shape[0]
+        lower = np.concatenate([self.lower, samples], axis=0)
+        if lower.shape[0] > self.total_lower:
+            lower = np.partition(lower, self.total_lower - 1, axis=0)[:self.total_lower]
+        upper = np.concatenate([self.upper, samples], axis=0)
+        if upper.shape[0] > self.total_upper:
+            upper = np.partition(upper, upper.shape[0] - self.total_upper, axis=0)[-self.total_upper:]
+        self.lower, self.upper = lower, upper
+
+    def _quantile(self, tail: np.ndarray, q: float, offset: int) -> np.ndarray:
+        # mirrors the virtual index & interpolation of np.quantile(method="linear")
+        n = self.count
+        virtual_index = np.clip((n - 1) * q, 0, n - 1)
+        previous_index = int(np.floor(virtual_index))
+        next_index = min(previous_index + 1, n - 1)
+        gamma = virtual_index - previous_index
+        tail = np.sort(tail, axis=0)
+        a, b = tail[previous_index - offset], tail[next_index - offset]
+        diff_b_a = b - a
+        return b - diff_b_a * (1 - gamma) if gamma >= 0.5 else a + diff_b_a * gamma
+
+    def result(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self.count == 0:
+            empty = np.full(self.total.shape[0], np.nan)
+            return empty, empty.copy(), empty.copy()
+        upper_offset = self.count - self.upper.shape[0]
+        return self.total / self.count, \
+                self._quantile(self.lower, self.lower_q, 0), \
+                self._quantile(self.upper, self.upper_q, upper_offset)
+
+def bootstrap_profiles(matrix,
+                       N: int = 1_000,
+                       lower_q: float = 0.025,
+                       upper_q: float = 0.975,
+                       rng: Optional[np.random.Generator] = None,
+                       cumulative: bool = False,
+                       max_elements: int = 2**24,
+                       workers: int = 1,
+                       block_size: int = 100,
+                       streaming: bool = False,
+                       pool: Optional[BootstrapPool] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Bootstraps the mean-normalized column sums of `matrix` (rows: resampling units, columns: positions).
+
+    Each resample is drawn as a vector of multinomial counts over the rows, so that a chunk of
+    resamples is a single weights x matrix product; `matrix` may be dense or scipy sparse.
+    With `cumulative`, rows hold difference arrays and the resampled sums are integrated first.
+    The N resamples are split in blocks of `block_size`, each with its own stream spawned from `rng`;
+    blocks run on `workers` processes reading the matrix from shared memory, so that the result
+    only depends on the seed and never on the number of workers.
+    With `streaming`, blocks are folded into exact running order statistics as they arrive,
+    so memory holds the quantile tails instead of all N x positions resamples.
+    A `BootstrapPool` replaces `workers` & keeps the processes alive across calls.
+    Returns the average, lower & upper quantiles of the resampled profiles.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    block_sizes = [min(block_size, N - block_start) for block_start in range(0, N, block_size)]
+    block_rngs = rng.spawn(len(block_sizes))
+    if len(block_sizes) == 1:
+        workers, pool = 1, None
+    with _block_sampler(matrix, workers, cumulative, max_elements, pool=pool) as sample_blocks:
+        if streaming:
+            quantiles = _StreamingQuantiles(N, lower_q, upper_q, matrix.shape[1] - int(cumulative))
+            for block in sample_blocks(block_sizes, block_rngs):
+                quantiles.update(block)
+            return quantiles.result()
+        samples = list(sample_blocks(block_sizes, block_rngs))
+    return _summarize(np.concatenate(samples, axis=0), lower_q, upper_q)
+
+def adaptive_bootstrap_profiles(matrix,
+                                min_N: int = 200,
+                                max_N: int = 5_000,
+                                lower_q: float = 0.025,
+                                upper_q: float = 0.975,
+                                tolerance: float = 5e-3,
+                                patience: int = 3,
+                                rng: Optional[np.random.Generator] = None,
+                                cumulative: bool = False,
+                                max_elements: int = 2**24,
+                                workers: int = 1,
+                                block_size: int = 100,
+                                pool: Optional[BootstrapPool] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """Bootstraps like `bootstrap_profiles`, but stops early once the confidence bounds have converged.
+
+    After every block the lower & upper quantile vectors are compared with those of the previous block;
+    resampling stops after `patience` consecutive blocks whose largest absolute change is below `tolerance`,
+    provided at least `min_N` resamples were drawn, and never exceeds `max_N`.
+    Blocks are evaluated in order, so the result still only depends on the seed.
+    Returns the average, lower & upper quantiles together with the number of resamples used.
+    """
+    if min_N > max_N:
+        raise ValueError(f"Minimum number of resamples {min_N} exceeds the maximum {max_N}.")
+    if rng is None:
+        rng = np.random.default_rng()
+    # a private child stream keeps discarded look-ahead blocks from shifting the caller's later draws
+    rng = rng.spawn(1)[0]
+    if pool is not None:
+        workers = pool.workers
     samples = []
+    total_resamples, stable_blocks = 0, 0
+    previous_bounds = None
+    converged = False
+    with _block_sampler(matrix, workers, cumulative, max_elements, pool=pool) as sample_blocks:
+        while total_resamples < max_N and not converged:
+            # draw one block per worker; blocks past the stopping point are discarded
+            block_sizes = []
+            for block_start in range(total_resamples, max_N, block_size):
+                block_sizes.append(min(block_size, max_N - block_start))
+                if len(block_sizes) == max(workers, 1):
+                    break
+            for block in sample_blocks(block_sizes, rng.spawn(len(block_sizes))):
+                samples.append(block)
+                total_resamples += block.shape[0]
+                _, lower, upper = _summarize(np.concatenate(samples, axis=0), lower_q, upper_q)
+                if previous_bounds is not None:
+                    change = np.nan_to_num(np.abs(np.concatenate([lower - previous_bounds[0], 
+                                                                  upper - previous_bounds[1]])))
+                    stable_blocks = stable_blocks + 1 if change.max(initial=0.0) < tolerance else 0
+                previous_bounds = (lower, upper)
+                if total_resamples >= min_N and stable_blocks >= patience:
+                    converged = True
+                    break
+    average, lower, upper = _summarize(np.concatenate(samples, axis=0), lower_q, upper_q)
+    return average, lower, upper, total_resamples
+
+def confidence_interval_bootstrap(df, alpha=0.95, total_resamples = 5000, rng=None, workers=1, streaming=True):
     df = df.select_dtypes(include=np.number)
     total_sum = df.sum(axis=0)
     mean = total_sum.mean()
     total_sum = (total_sum / mean).to_frame(name="mean")
-    for _ in tqdm(range(total_resamples)):
-        resample = df.sample(df.shape[0], replace=True)
-        resample_sum = resample.sum(axis=0)
-        mean = resample_sum.mean()
-        resample_sum = resample_sum / mean
-        samples.append(resample_sum)
-    samples = pd.DataFrame(samples)
-    confidence_intervals = {}
-    for col in samples:
-        temp = samples[col].sort_values(ascending=True)
-        confidence_intervals.update(
-                                {col: (np.percentile(temp, 100 * (1-alpha)/2), 
-                                           np.percentile(temp, 100 * (alpha+1)/2)
-                                        )
-                                    }
-                                   )
-        
-    confidence_intervals = pd.DataFrame(confidence_intervals).T
-    confidence_intervals.columns = ["inf", "sup"]
+    _, inf, sup = bootstrap_profiles(df.to_numpy(dtype=float),
+                                     N=total_resamples,
+                                     lower_q=(1-alpha)/2,
+                                     upper_q=(alpha+1)/2,
+                                     rng=rng,
+                                     workers=workers,
+                                     streaming=streaming)
+    confidence_intervals = pd.DataFrame({"inf": inf, "sup": sup}, index=df.columns)
     confidence_intervals = pd.concat([total_sum, confidence_intervals], axis=1)
     return confidence_intervals
@@ -1,14 +1,18 @@
+import numpy as np
 import pandas as pd 
 from collections import defaultdict
 from pathlib import Path
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 import json
 from termcolor import colored
-from tqdm import tqdm
 from typing import Optional
 from scipy.stats import ks_2samp
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from mindi.coverage.pwm_density import PWMExtractor
+from mindi.coverage.bootstrap import bootstrap_profiles, adaptive_bootstrap_profiles, BootstrapPool
 
 # plotting
 import matplotlib.pyplot as plt
@@ -19,68 +23,132 @@ class params:
     N: int = field(default=1000)
     window_size: int = field(default=500)
     alpha: float = field(default=0.05)
+    seed: Optional[int] = field(default=None)
+    adaptive: bool = field(default=False)
+    min_N: int = field(default=200)
+    tolerance: float = field(default=5e-3)
+    patience: int = field(default=3)
 
 def bootstrap_density(intersect_df: pd.DataFrame, 
                         window_size: int, 
                         nsamples: int = 1000, 
-                        alpha: float = 0.05) -> tuple:
-    df_bootstrap = []
+                        alpha: float = 0.05,
+                        rng: Optional[np.random.Generator] = None,
+                        workers: int = 1,
+                        cluster_columns: Optional[list[str]] = None,
+                        total_clusters: Optional[int] = None) -> tuple:
     extractor = PWMExtractor()
-    for _ in tqdm(range(nsamples), leave=True, position=0):
-        df_sample = intersect_df.sample(frac=1.0, replace=True)
-        df_sample = extractor.extract_density(df_sample, 
-                                              window_size=window_size, 
-                                              enrichment=True,
-                                              return_array=True)
-        df_bootstrap.append(df_sample)
-    df_bootstrap = pd.DataFrame(df_bootstrap)
-    mean = df_bootstrap.mean()
-    ci_lower = df_bootstrap.quantile(alpha/2)
-    ci_upper = df_bootstrap.quantile(1-alpha/2)
-    return mean, ci_lower, ci_upper
+    if cluster_columns is not None:
+        # resample whole windows (genes) instead of single intersections
+        matrix = extractor.cluster_matrix(intersect_df, window_size, cluster_columns, total_clusters)
+    else:
+        matrix = extractor.difference_matrix(intersect_df, window_size)
+    mean, ci_lower, ci_upper = bootstrap_profiles(matrix,
+                                                  N=nsamples,
+                                                  lower_q=alpha/2,
+                                                  upper_q=1-alpha/2,
+                                                  rng=rng,
+                                                  cumulative=True,
+                                                  workers=workers)
+    return pd.Series(mean), pd.Series(ci_lower), pd.Series(ci_upper)
 
 def bootstrap(df: pd.DataFrame, 
               N: int = 1_000, 
-              alpha: float = 0.05) -> tuple:
-    bootstrapped_samples = []
-    for _ in tqdm(range(N), leave=True, position=0):
-        sample_df = df.sample(frac=1.0, replace=True)
-        sample_df = sample_df.sum(axis=0)
-        mean = sample_df.mean()
-        resampled_sum = sample_df / mean
-        bootstrapped_samples.append(resampled_sum)
-    bootstrapped_samples = pd.DataFrame(bootstrapped_samples)
-    average = bootstrapped_samples.mean(axis=0)
+              alpha: float = 0.05,
+              rng: Optional[np.random.Generator] = None,
+              workers: int = 1,
+              pool: Optional[BootstrapPool] = None) -> tuple:
     # two-tailed interval (1-a)%
-    lower_ci = bootstrapped_samples.quantile(alpha/2)
-    upper_ci = bootstrapped_samples.quantile(1 - alpha/2)
-    return average, lower_ci, upper_ci
+    average, lower_ci, upper_ci = bootstrap_profiles(df.to_numpy(dtype=float),
+                                                     N=N,
+                                                     lower_q=alpha/2,
+                                                     upper_q=1-alpha/2,
+                                                     rng=rng,
+                                                     workers=workers,
+                                                     pool=pool)
+    return pd.Series(average, index=df.columns), \
+            pd.Series(lower_ci, index=df.columns), \
+            pd.Series(upper_ci, index=df.columns)
+
+def adaptive_bootstrap(df: pd.DataFrame, 
+                       min_N: int = 200,
+                       max_N: int = 1_000, 
+                       alpha: float = 0.05,
+                       tolerance: float = 5e-3,
+                       patience: int = 3,
+                       rng: Optional[np.random.Generator] = None,
+                       workers: int = 1,
+                       pool: Optional[BootstrapPool] = None) -> tuple:
+    # resample until the (1-a)% interval stops moving
+    average, lower_ci, upper_ci, total_resamples = adaptive_bootstrap_profiles(df.to_numpy(dtype=float),
+                                                                               min_N=min_N,
+                                                                               max_N=max_N,
+                                                                               lower_q=alpha/2,
+                                                                               upper_q=1-alpha/2,
+                                                                               tolerance=tolerance,
+                                                                               patience=patience,
+                                                                               rng=rng,
+                                                                               workers=workers,
+                                                                               pool=pool)
+    return pd.Series(average, index=df.columns), \
+            pd.Series(lower_ci, index=df.columns), \
+            pd.Series(upper_ci, index=df.columns), \
+            total_resamples
 
 class Bootstrapper:
     
-    def __init__(self, enrichment_file: str, design: str, params=params) -> None:
+    def __init__(self, enrichment_file: str, design: str, params=params, workers: int = 1) -> None:
         self.enrichment_df = None
         self.enrichment_file = Path(enrichment_file).resolve()
         self.design = Path(design).resolve()
         self.params = params
+        self.rng = np.random.default_rng(params.seed)
+        self.workers = workers
         self.combinations = [
                         ("Occurrences", "protein_coding"),
                         ("Occurrences", "non_coding") ]
         self.taxonomic_ranks = ["phylum", "kingdom", "superkingdom"]
+        self.bin_size = 1
+        self._rollups = {}
+        self.rank_filter = None
+        self._pool = None
         if not self.design.is_file():
             raise FileNotFoundError(f"Could not detect design file `{design}`.") 
         if not self.enrichment_file.is_file():
             raise FileNotFoundError(f"Could not detect enrichment file `{enrichment_file}`.") 
 
-    def load_table(self, taxonomic_ranks: Optional[list[str]] = None):
-        if self.enrichment_df is not None:
+    def load_table(self, 
+                   taxonomic_ranks: Optional[list[str]] = None, 
+                   rank_filter: Optional[tuple[str, str]] = None):
+        """Loads the enrichment table joined with the design taxonomy.
+
+        With `rank_filter` = (taxonomic rank, value), tables that carry the taxonomy are read through
+        pyarrow predicate pushdown, so only the row groups whose statistics may hold the value are read.
+        A loaded table is reused for any later rank that it covers.
+        """
+        if self.enrichment_df is not None and self.rank_filter in {None, rank_filter}:
             return self
         if taxonomic_ranks is None:
             taxonomic_ranks = self.taxonomic_ranks
         if not isinstance(taxonomic_ranks, list):
             raise TypeError(f"Invalid type for taxonomic ranks. Expected list, but received {type(taxonomic_ranks)}.")
-        design_df = pd.read_csv(self.design, usecols=["accession_id"] + taxonomic_ranks)
-        enrichment_df = pd.read_parquet(self.enrichment_file, engine="fastparquet")\
+        schema = pq.read_schema(self.enrichment_file)
+        # binned enrichment tables record their resolution in the parquet metadata
+        metadata = schema.metadata or {}
+        self.bin_size = int(metadata.get(b"bin_size", 1))
+        if "window_size" not in schema.names and int(metadata.get(b"window_size", self.params.window_size)) != self.params.window_size:
+            raise ValueError(f"Enrichment table `{self.enrichment_file}` holds profiles of window size {int(metadata[b'window_size'])}, not {self.params.window_size}.")
+        filters = []
+        if rank_filter is not None and rank_filter[0] in schema.names:
+            filters.append((rank_filter[0], "==", rank_filter[1]))
+        else:
+            rank_filter = None
+        if "window_size" in schema.names:
+            # multi-window enrichment tables; keep the profiles of the requested window size
+            filters.append(("window_size", "==", self.params.window_size))
+        # ranks already joined by the reduce step are not taken again from the design
+        design_df = pd.read_csv(self.design, usecols=["accession_id"] + [rank for rank in taxonomic_ranks if rank not in schema.names])
+        enrichment_df = pd.read_parquet(self.enrichment_file, engine="pyarrow", filters=filters or None)\
                         .merge(
                                 design_df,
                                 right_on="accession_id",
@@ -88,8 +156,43 @@ class Bootstrapper:
                                 how="inner"
                               )
         self.enrichment_df = enrichment_df
+        self.rank_filter = rank_filter
+        self._rollups = {}
         return self
 
+    @contextmanager
+    def worker_pool(self):
+        """Keeps one pool of resampling processes alive for every bootstrap run inside the block."""
+        if self._pool is not None or self.workers <= 1:
+            yield self._pool
+            return
+        with BootstrapPool(self.workers) as pool:
+            self._pool = pool
+            try:
+                yield pool
+            finally:
+                self._pool = None
+
+    def _bootstrap(self, df: pd.DataFrame) -> tuple:
+        """Bootstraps the profiles of `df`; returns the average, lower & upper CI and the resampling iterations used."""
+        if self.params.adaptive:
+            return adaptive_bootstrap(df, 
+                                      min_N=self.params.min_N, 
+                                      max_N=self.params.N, 
+                                      alpha=self.params.alpha,
+                                      tolerance=self.params.tolerance,
+                                      patience=self.params.patience,
+                                      rng=self.rng,
+                                      workers=self.workers,
+                                      pool=self._pool)
+        average, lower_ci, upper_ci = bootstrap(df, N=self.params.N, alpha=self.params.alpha, rng=self.rng, workers=self.workers, pool=self._pool)
+        return average, lower_ci, upper_ci, self.params.N
+
+    @property
+    def positions(self) -> list[str]:
+        """Profile columns of the enrichment table for the configured window & bin size."""
+        return [str(i) for i in PWMExtractor.profile_positions(self.params.window_size, self.bin_size)]
+
     def bootstrap_enrichment_density(self, 
                                      taxonomic_rank: str, 
                                      rank: str, 
@@ -97,46 +200,70 @@ class Bootstrapper:
                                      taxonomic_ranks: Optional[list[str]] = None, 
                                      combinations: Optional[list[tuple]] = None) -> None:
 
-        enrichment_df = self.load_table(taxonomic_ranks=taxonomic_ranks).enrichment_df
+        enrichment_df = self.load_table(taxonomic_ranks=taxonomic_ranks, rank_filter=(taxonomic_rank, rank)).enrichment_df
         if taxonomic_rank not in enrichment_df:
             raise KeyError(f"Invalid specified taxonomic rank `{taxonomic_rank}`.")
         enrichment_df = enrichment_df.query(f"{taxonomic_rank} == '{rank}'").copy()
+        with self.worker_pool():
+            self._bootstrap_rank_density(enrichment_df, taxonomic_rank, rank, output, combinations=combinations)
 
+    def _bootstrap_rank_density(self, 
+                                enrichment_df: pd.DataFrame, 
+                                taxonomic_rank: str, 
+                                rank: str, 
+                                output: str, 
+                                combinations: Optional[list[tuple]] = None) -> None:
         print(f"Initializing bootstrap for taxonomic rank {taxonomic_rank} with value=`{rank}`.")
         print(f"Specified confidence: {1e2 * (1-self.params.alpha):.2f}")
-        print(f"Total resampling iterations: {self.params.N}")
+        if self.params.adaptive:
+            print(f"Adaptive resampling iterations: {self.params.min_N}-{self.params.N} (tolerance {self.params.tolerance}).")
+        else:
+            print(f"Total resampling iterations: {self.params.N}")
         if enrichment_df.shape[0] == 0:
             raise ValueError(f"Empty dataframe for taxonomic rank `{taxonomic_rank}` with value=`{rank}`.")
         if combinations is None:
             combinations = self.combinations
         ## Domain level bootstrap
         confidence_intervals = defaultdict(list)
+        iterations = {}
         for comb in combinations: 
             _, biotype = comb
             temp_df = enrichment_df[enrichment_df["biotype"] == biotype]\
-                        [[str(i) for i in range(-params.window_size, params.window_size+1)]]
-            average, lower_ci, upper_ci = bootstrap(temp_df, N=params.N, alpha=params.alpha)
+                        [self.positions]
+            average, lower_ci, upper_ci, total_resamples = self._bootstrap(temp_df)
             biotype = biotype.replace("_coding", "Coding")
             confidence_intervals[f"average_{biotype}_{rank}"] = average
             confidence_intervals[f"lowerCI_{biotype}_{rank}"] = lower_ci
             confidence_intervals[f"upperCI_{biotype}_{rank}"] = upper_ci
+            iterations.update({f"{stat}_{biotype}_{rank}": total_resamples for stat in ["average", "lowerCI", "upperCI"]})
         confidence_intervals = pd.DataFrame(confidence_intervals).T
         confidence_intervals["biotype"] = confidence_intervals.index.map(lambda x: x.split("_")[2])
         confidence_intervals[taxonomic_rank] = rank
-        confidence_intervals = confidence_intervals[[taxonomic_rank, "biotype"] + [str(i) for i in range(-params.window_size, params.window_size+1)]]
+        confidence_intervals["iterations"] = confidence_intervals.index.map(iterations)
+        confidence_intervals = confidence_intervals[[taxonomic_rank, "biotype", "iterations"] + self.positions]
         confidence_intervals.to_csv(output, sep=",", mode="w", header=True, index=True)
         print(colored(f"Bootstrap has succesfully been completed for taxonomic rank {taxonomic_rank}=`{rank}`.", "green"))
         return
         
     def bootstrap_enrichment(self, taxonomic_rank: str, rank: str, output: str) -> None:
-        enrichment_df = self.load_table().enrichment_df
+        enrichment_df = self.load_table(rank_filter=(taxonomic_rank, rank)).enrichment_df
         if taxonomic_rank not in enrichment_df:
             raise KeyError(f"Invalid specified taxonomic rank `{taxonomic_rank}`.")
         enrichment_df = enrichment_df.query(f"{taxonomic_rank} == '{rank}'").copy()
+        with self.worker_pool():
+            self._bootstrap_rank_template(enrichment_df, taxonomic_rank, rank, output)
 
+    def _bootstrap_rank_template(self, 
+                                 enrichment_df: pd.DataFrame, 
+                                 taxonomic_rank: str, 
+                                 rank: str, 
+                                 output: str) -> None:
         print(f"Initializing bootstrap for taxonomic rank {taxonomic_rank} with value=`{rank}`.")
         print(f"Specified confidence: {1e2 * (1-self.params.alpha):.2f}")
-        print(f"Total resampling iterations: {self.params.N}")
+        if self.params.adaptive:
+            print(f"Adaptive resampling iterations: {self.params.min_N}-{self.params.N} (tolerance {self.params.tolerance}).")
+        else:
+            print(f"Total resampling iterations: {self.params.N}")
         if enrichment_df.shape[0] == 0:
             raise ValueError(f"Empty dataframe for taxonomic rank `{taxonomic_rank}` with value=`{rank}`.")
         
@@ -146,16 +273,18 @@ class Bootstrapper:
                         ("Occurrences_non_template", "non_coding")]
         ## Domain level bootstrap
         confidence_intervals = defaultdict(list)
+        iterations = {}
         for comb in combinations: 
             typ, biotype = comb
             temp_df = enrichment_df[(enrichment_df["template|non_template"] == typ) & (enrichment_df["biotype"] == biotype)]\
-                        [[str(i) for i in range(-params.window_size, params.window_size+1)]]
-            average, lower_ci, upper_ci = bootstrap(temp_df, N=params.N, alpha=params.alpha)
+                        [self.positions]
+            average, lower_ci, upper_ci, total_resamples = self._bootstrap(temp_df)
             biotype = biotype.replace("_coding", "Coding")
             typ = typ.replace("non_template", "non-template").replace("Occurrences_", "")
             confidence_intervals[f"average_{typ}_{biotype}_{rank}"] = average
             confidence_intervals[f"lowerCI_{typ}_{biotype}_{rank}"] = lower_ci
             confidence_intervals[f"upperCI_{typ}_{biotype}_{rank}"] = upper_ci
+            iterations.update({f"{stat}_{typ}_{biotype}_{rank}": total_resamples for stat in ["average", "lowerCI", "upperCI"]})
 
         #        for biotype in ["protein_coding", "non_coding"]:
         #            avg_template = confidence_intervals[f"average_Occurrences_template_{biotype}_{domain}"]
@@ -165,39 +294,133 @@ class Bootstrapper:
         confidence_intervals["biotype"] = confidence_intervals.index.map(lambda x: x.split("_")[3])
         confidence_intervals[taxonomic_rank] = rank
         confidence_intervals["typ"] = confidence_intervals.index.map(lambda x: x.split("_")[2])
-        confidence_intervals = confidence_intervals[[taxonomic_rank, "biotype", "typ"] + [str(i) for i in range(-params.window_size, params.window_size+1)]]
+        confidence_intervals["iterations"] = confidence_intervals.index.map(iterations)
+        confidence_intervals = confidence_intervals[[taxonomic_rank, "biotype", "typ", "iterations"] + self.positions]
         confidence_intervals.to_csv(output, sep=",", mode="w", header=True, index=True)
         print(colored(f"Bootstrap has succesfully been completed for taxonomic rank {taxonomic_rank}=`{rank}`.", "green"))
         return
 
-    def average_phylums(self, domain: str, output: str, join_templates: int = 0) -> None:
-        self.load_table()
-        enrichment_df = self.enrichment_df
-        if "superkingdom" not in enrichment_df:
-            raise KeyError(f"Invalid specified domain `{domain}`.")
-        enrichment_df = enrichment_df.query(f"superkingdom == '{domain}'").copy()
-        if "phylum" not in enrichment_df: 
-            raise KeyError(f"No phylums detected for domain `{domain}`.")
+    def bootstrap_ranks(self, 
+                        taxonomic_rank: str, 
+                        outputs: dict[str, str], 
+                        mode: str = "template") -> None:
+        """Bootstraps every rank value of `outputs` ({rank: output}) from a single load of the enrichment table.
+
+        Rank values without rows get a header-only output instead of failing the whole batch.
+        """
+        if mode not in {"template", "density"}:
+            raise ValueError(f"Invalid bootstrap mode `{mode}`.")
+        enrichment_df = self.load_table().enrichment_df
+        if taxonomic_rank not in enrichment_df:
+            raise KeyError(f"Invalid specified taxonomic rank `{taxonomic_rank}`.")
+        # split the table once, instead of querying it per rank value
+        rank_groups = {rank: rank_df for rank, rank_df in enrichment_df.groupby(taxonomic_rank, sort=False)}
+        # the resampling processes are started once for every rank value
+        with self.worker_pool():
+            for rank, output in outputs.items():
+                rank_df = rank_groups.get(rank, enrichment_df.iloc[:0])
+                if rank_df.shape[0] == 0:
+                    # one missing rank value must not discard the outputs of the others
+                    print(colored(f"Empty dataframe for taxonomic rank `{taxonomic_rank}` with value=`{rank}`; writing an empty output.", "red"))
+                    strand_columns = ["typ"] if mode == "template" else []
+                    pd.DataFrame([], columns=[taxonomic_rank, "biotype"] + strand_columns + ["iterations"] + self.positions)\
+                      .to_csv(output, sep=",", mode="w", header=True, index=True)
+                    continue
+                if mode == "template":
+                    self._bootstrap_rank_template(rank_df, taxonomic_rank, rank, output)
+                else:
+                    self._bootstrap_rank_density(rank_df, taxonomic_rank, rank, output)
+        return
+
+    def rank_rollup(self, join_templates: int = 0, output: Optional[str] = None) -> pd.DataFrame:
+        """Mean-normalized summed profiles of every (domain, rank, rank value, [template flag], biotype).
+
+        All groups of a rank are summed in one sorted `reduceat` over the profile matrix and normalized
+        by broadcasting; the cube is cached and, with `output`, written to parquet once per site, so
+        that domain, kingdom & phylum averages are slices of it (see `average_phylums`).
+        """
+        if self.enrichment_df is None or (output is not None and self.rank_filter is not None):
+            # a persisted cube covers the whole table, not a rank-filtered slice of it
+            self.load_table()
+        if join_templates not in self._rollups:
+            # rolls up the loaded table, which may be restricted to a single rank value
+            enrichment_df = self.enrichment_df
+            if "superkingdom" not in enrichment_df:
+                raise KeyError("Taxonomic rank `superkingdom` is missing from the enrichment table.")
+            strand_columns = ["template|non_template"] if "template|non_template" in enrichment_df and not join_templates else []
+            profiles = enrichment_df[self.positions].to_numpy(dtype=float)
+            rollup = []
+            for taxonomic_rank in self.taxonomic_ranks:
+                if taxonomic_rank not in enrichment_df:
+                    continue
+                rank_columns = ["superkingdom"] if taxonomic_rank == "superkingdom" else ["superkingdom", taxonomic_rank]
+                grouped = enrichment_df.groupby(rank_columns + strand_columns + ["biotype"], sort=True)
+                codes = grouped.ngroup().to_numpy()
+                # rows with a missing key are left out, as by groupby
+                rows = np.flatnonzero(codes >= 0)
+                rows = rows[np.argsort(codes[rows], kind="stable")]
+                if rows.shape[0] == 0:
+                    continue
+                starts = np.flatnonzero(np.diff(codes[rows], prepend=-1))
+                summed = np.add.reduceat(profiles[rows], starts, axis=0)
+                rank_df = grouped.size().index.to_frame(index=False)
+                rank_df["value"] = rank_df[taxonomic_rank]
+                rank_df["rank"] = taxonomic_rank
+                rank_df = pd.concat([rank_df[["rank", "superkingdom", "value"] + strand_columns + ["biotype"]], 
+                                     pd.DataFrame(np.round(summed / summed.mean(axis=1, keepdims=True), 2), columns=self.positions)], 
+                                    axis=1)
+                if taxonomic_rank == "phylum" and "kingdom" in enrichment_df:
+                    # most frequent kingdom of every phylum among its genomes with a recorded kingdom
+                    kingdoms = enrichment_df.dropna(subset=["phylum", "kingdom"])\
+                                            .drop_duplicates(subset=["#assembly_accession"])\
+                                            .groupby(["superkingdom", "phylum"])["kingdom"]\
+                                            .agg(lambda kingdom: kingdom.value_counts().index[0])
+                    rank_df["kingdom"] = kingdoms.reindex(pd.MultiIndex.from_frame(rank_df[["superkingdom", "value"]])).to_numpy()
+                rollup.append(rank_df)
+            self._rollups[join_templates] = pd.concat(rollup, axis=0, ignore_index=True)
+        rollup = self._rollups[join_templates]
+        if output is not None:
+            table = pa.Table.from_pandas(rollup, preserve_index=False)
+            # the profile resolution & strand handling travel with the cube
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   b"bin_size": str(self.bin_size).encode(),
+                                                   b"bin_edges": json.dumps({self.params.window_size: PWMExtractor.profile_bins(self.params.window_size, self.bin_size)}).encode(),
+                                                   b"join_templates": str(int(join_templates)).encode()})
+            pq.write_table(table, output)
+        return rollup
+
+    def read_rollup(self, rollup_file: str, filters: Optional[list[tuple]] = None, join_templates: int = 0) -> pd.DataFrame:
+        """Reads a slice of a rank rollup written by `rank_rollup`."""
+        metadata = pq.read_schema(rollup_file).metadata or {}
+        if int(metadata.get(b"join_templates", 0)) != int(join_templates):
+            raise ValueError(f"Rank rollup `{rollup_file}` was built with join_templates={int(metadata.get(b'join_templates', 0))}.")
+        self.bin_size = int(metadata.get(b"bin_size", 1))
+        return pd.read_parquet(rollup_file, engine="pyarrow", filters=filters)
+
+    def average_phylums(self, domain: str, output: str, join_templates: int = 0, rollup_file: Optional[str] = None) -> None:
         ## Phylum calculation
-        ## keep assembly accessions with a present phylum
-        enrichment_df_phylum = enrichment_df.dropna(subset=['phylum'])
-        phylum_to_kingdom = enrichment_df_phylum[["phylum", "kingdom"]].set_index("phylum")["kingdom"].to_dict()
-        if "template|non_template" in enrichment_df_phylum and not join_templates:
-            print(colored("Template & Non-template partition detected.", "blue"))
-            enrichment_df_phylum = enrichment_df_phylum.groupby(["phylum", 
-                                                                 "template|non_template", 
-                                                                 "biotype"])
+        ## slice the phylums of the domain from the rank rollup, read from `rollup_file` when persisted
+        if rollup_file is not None:
+            rollup = self.read_rollup(rollup_file, 
+                                      filters=[("rank", "==", "phylum"), ("superkingdom", "==", domain)],
+                                      join_templates=join_templates)
         else:
-            enrichment_df_phylum = enrichment_df_phylum.groupby(["phylum", "biotype"])
-        enrichment_df_phylum = enrichment_df_phylum.agg({str(i): "sum" \
-                                                            for i in range(-params.window_size, params.window_size+1)
-                                                        })
-        enrichment_df_phylum = enrichment_df_phylum.apply(lambda row: row / row.mean(), axis=1)
-        for col in range(-params.window_size, params.window_size+1):
-            enrichment_df_phylum[str(col)] = enrichment_df_phylum[str(col)].round(2)
-        enrichment_df_phylum.reset_index(inplace=True)
-        enrichment_df_phylum.loc[:, "kingdom"] = enrichment_df_phylum["phylum"].map(phylum_to_kingdom)
-        enrichment_df_phylum.loc[:, "domain"] = domain
+            self.load_table(rank_filter=("superkingdom", domain))
+            enrichment_df = self.enrichment_df
+            if "superkingdom" not in enrichment_df:
+                raise KeyError(f"Invalid specified domain `{domain}`.")
+            if "phylum" not in enrichment_df: 
+                raise KeyError(f"No phylums detected for domain `{domain}`.")
+            rollup = self.rank_rollup(join_templates=join_templates)
+        strand_columns = []
+        if "template|non_template" in rollup:
+            print(colored("Template & Non-template partition detected.", "blue"))
+            strand_columns = ["template|non_template"]
+        enrichment_df_phylum = rollup[(rollup["rank"] == "phylum") & (rollup["superkingdom"] == domain)]\
+                                    .rename(columns={"value": "phylum"})\
+                                    [["phylum"] + strand_columns + ["biotype"] + self.positions + ["kingdom"]]\
+                                    .reset_index(drop=True)
+        enrichment_df_phylum["domain"] = domain
         enrichment_df_phylum.to_csv(output, sep=",", mode="w", header=True, index=True)
         print(colored(f"Phylum averaging has succesfully been completed for domain=`{domain}`.", "green"))
         return
@@ -215,6 +438,13 @@ if __name__ == "__main__":
     parser.add_argument("--output", type=str, default="bootstrap.txt")
     parser.add_argument("--window_size", type=int, default=500)
     parser.add_argument("--rank", type=str, default="Bacteria", choices=["Eukaryota", "Archaea", "Viruses", "Bacteria"])
+    parser.add_argument("--ranks", type=str, nargs="+", default=None, help="Bootstrap several rank values from one load; `--output` must contain `{rank}`.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--adaptive", action="store_true", help="Stop resampling once the confidence intervals converge; `--N` is the maximum.")
+    parser.add_argument("--min_N", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=5e-3)
+    parser.add_argument("--patience", type=int, default=3)
     args = parser.parse_args()
     N = args.N 
     alpha = args.alpha
@@ -225,11 +455,25 @@ if __name__ == "__main__":
     enrichment_file = args.enrichment
     output = args.output
     mode = args.mode
-    param = params(alpha=alpha, N=N, window_size=window_size)
+    param = params(alpha=alpha, 
+                   N=N, 
+                   window_size=window_size, 
+                   seed=args.seed,
+                   adaptive=args.adaptive,
+                   min_N=args.min_N,
+                   tolerance=args.tolerance,
+                   patience=args.patience)
     bootstrapper = Bootstrapper(params=param, 
                                 design=design, 
-                                enrichment_file=enrichment_file)
-    if mode == "template":
+                                enrichment_file=enrichment_file,
+                                workers=args.workers)
+    if args.ranks:
+        if "{rank}" not in output:
+            raise ValueError(f"Output `{output}` must contain a `{{rank}}` placeholder when bootstrapping several ranks.")
+        bootstrapper.bootstrap_ranks(taxonomic_rank=taxonomic_rank,
+                                     outputs={rank: output.format(rank=rank.replace(' ', '-')) for rank in args.ranks},
+                                     mode=mode)
+    elif mode == "template":
         bootstrapper.bootstrap_enrichment(taxonomic_rank=taxonomic_rank,
                                       rank=rank,
                                       output=output)
@@ -12,16 +12,20 @@ import os
 from termcolor import colored
 import json
 import logging
+import numpy as np
 import polars as pl
 import pandas as pd
 import threading
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import pyarrow as pa
 import pysam
 import attr
 from attr import field
 from Bio import SeqIO
 from Bio.Seq import Seq
 from typing import Optional, ClassVar, Iterator
-from pybedtools import BedTool
+from mindi.coverage.utils import BucketCheckpoint
 
 
 @attr.s(slots=True, kw_only=True)
@@ -206,58 +210,129 @@ class GFFExtractor:
                                 pl.lit("Promoter").alias("compartment")
                             )
 
-    def merge(self, gff_table: pl.DataFrame, faidx: Optional[str] = None) -> pl.DataFrame:
-        unique_compartments = set(gff_table["compartment"])
-        merged_gff: list[pl.DataFrame] = []
-        for compartment in unique_compartments:
-            gff_table_bed = BedTool.from_dataframe(
-                                        gff_table.filter(pl.col("compartment") == compartment)
-                                        .select(["seqID", "start", "end"])
-                                        .to_pandas()
-                                        )
-            if faidx is not None:
-                gff_table_bed = gff_table_bed.sort(faidx=faidx)
-            else:
-                gff_table_bed = gff_table_bed.sort()
-            gff_temp = pl.read_csv(
-                             gff_table_bed.merge(c="3", 
-                                                 o="count", 
-                                                 delim=self.delim).fn,
-                             has_header=False,
-                             new_columns=["seqID", "start", "end", "counts"],
-                             separator="\t",
+    @staticmethod
+    def read_faidx(faidx: str) -> list[str]:
+        with open(faidx, mode="r", encoding="utf-8") as f:
+            return [line.split("\t", 1)[0] for line in f if line.strip()]
+
+    @staticmethod
+    def sort_intervals(intervals: pl.DataFrame, seqID_order: Optional[list[str]] = None, by: Optional[list[str]] = None) -> pl.DataFrame:
+        """Sorts by (*by, seqID, start), with seqIDs ordered lexically or as in a FASTA index."""
+        by = by or []
+        if seqID_order is None:
+            return intervals.sort(by + ["seqID", "start"], maintain_order=True)
+        # unindexed sequences follow
+        order = pl.DataFrame({"seqID": seqID_order, "_seqRank": range(len(seqID_order))},
+                             schema_overrides={"seqID": intervals.schema["seqID"]})
+        return intervals.join(order, on="seqID", how="left", maintain_order="left")\
+                        .sort(by + ["_seqRank", "seqID", "start"], nulls_last=True, maintain_order=True)\
+                        .drop("_seqRank")
+
+    @staticmethod
+    def merge_intervals(intervals: pl.DataFrame, seqID_order: Optional[list[str]] = None, by: Optional[list[str]] = None) -> pl.DataFrame:
+        """Merges overlapping & book-ended intervals per seqID, as `bedtools merge -c 3 -o count`.
+
+        Intervals are sorted by (*by, seqID, start); a cluster is cut whenever the start exceeds
+        the running maximum end of the preceding intervals of the same group & seqID, so every
+        group in `by` is merged in the same pass.
+        """
+        by = by or []
+        intervals = GFFExtractor.sort_intervals(intervals, seqID_order=seqID_order, by=by)
+        previous_end = pl.col("end").cum_max().shift(1).over(by + ["seqID"])
+        return intervals.with_columns(
+                                (previous_end.is_null() | (pl.col("start") > previous_end))
+                                .cum_sum()
+                                .alias("_cluster")
                             )\
-                            .with_columns(
-                                pl.lit(compartment).alias("compartment")
+                        .group_by("_cluster", maintain_order=True)\
+                        .agg(
+                                pl.col("seqID").first(),
+                                pl.col("start").min(),
+                                pl.col("end").max(),
+                                pl.len().cast(pl.Int64).alias("counts"),
+                                *[pl.col(key).first() for key in by]
+                            )\
+                        .drop("_cluster")
+
+    def merge(self, gff_table: pl.DataFrame, faidx: Optional[str] = None, by: Optional[list[str]] = None) -> pl.DataFrame:
+        """Merges the intervals of every compartment (and of every group in `by`) in one sorted pass."""
+        seqID_order = None
+        if faidx is not None:
+            seqID_order = GFFExtractor.read_faidx(faidx)
+        keys = ["compartment"] + (by or [])
+        return GFFExtractor.merge_intervals(
+                                gff_table.select(["seqID", "start", "end"] + keys),
+                                seqID_order=seqID_order,
+                                by=keys
                             )
-            merged_gff.append(gff_temp)
-        merged_gff = pl.concat(merged_gff)
-        return merged_gff
+
+    @staticmethod
+    def _covered_bases(positions: np.ndarray, union_start: np.ndarray, union_end: np.ndarray, union_prefix: np.ndarray) -> np.ndarray:
+        """Bases covered by the disjoint, sorted union intervals upstream of each position."""
+        k = np.searchsorted(union_start, positions, side="left") - 1
+        inside = k >= 0
+        k = np.maximum(k, 0)
+        covered = union_prefix[k] + np.minimum(positions, union_end[k]) - union_start[k]
+        return np.where(inside, covered, 0)
+
+    @staticmethod
+    def interval_coverage(gff_table: pl.DataFrame, extraction_table: pl.DataFrame) -> pl.DataFrame:
+        """Appends the `bedtools coverage -a gff_table -b extraction_table` fields to each interval.
+
+        Hits are counted by binary search over the sorted starts & ends of each chromosome;
+        overlapping bases are differences of the cumulative length of the merged hits.
+        """
+        hits = extraction_table.select(pl.col("seqID").cast(pl.String), "start", "end")
+        union = GFFExtractor.merge_intervals(hits)
+        hit_arrays = {seqID: (np.sort(df["start"].to_numpy()), np.sort(df["end"].to_numpy()))
+                        for (seqID,), df in hits.partition_by("seqID", as_dict=True).items()}
+        union_arrays = {}
+        for (seqID,), df in union.partition_by("seqID", as_dict=True).items():
+            union_start = df["start"].to_numpy()
+            union_end = df["end"].to_numpy()
+            union_prefix = np.concatenate(([0], np.cumsum(union_end - union_start)[:-1]))
+            union_arrays[seqID] = (union_start, union_end, union_prefix)
+
+        total_hits = np.zeros(gff_table.height, dtype=np.int64)
+        overlapping_bp = np.zeros(gff_table.height, dtype=np.int64)
+        intervals = gff_table.select(pl.col("seqID").cast(pl.String), "start", "end").with_row_index("row")
+        for (seqID,), df in intervals.partition_by("seqID", as_dict=True).items():
+            if seqID not in hit_arrays:
+                continue
+            rows = df["row"].to_numpy()
+            start = df["start"].to_numpy()
+            end = df["end"].to_numpy()
+            hit_start, hit_end = hit_arrays[seqID]
+            # hits starting before the end minus hits ending before the start
+            total_hits[rows] = np.searchsorted(hit_start, end, side="left") - np.searchsorted(hit_end, start, side="right")
+            overlapping_bp[rows] = GFFExtractor._covered_bases(end, *union_arrays[seqID]) \
+                                    - GFFExtractor._covered_bases(start, *union_arrays[seqID])
+        compartment_length = (gff_table["end"] - gff_table["start"]).to_numpy()
+        return gff_table.with_columns(
+                            pl.Series("totalHits", total_hits),
+                            pl.Series("overlappingBp", overlapping_bp),
+                            pl.Series("compartmentLength", compartment_length),
+                            pl.Series("coverage", np.divide(overlapping_bp, compartment_length,
+                                                            out=np.zeros(gff_table.height),
+                                                            where=compartment_length > 0))
+                        )
 
     def parse_coverage(self, gff_table: pl.DataFrame, 
                             extraction_table: pl.DataFrame,
                             group: bool = True,
-                            faidx: Optional[str] = None) -> pl.DataFrame:
-        if isinstance(gff_table, pl.DataFrame):
-            gff_table = gff_table.to_pandas()
-        if isinstance(extraction_table, pl.DataFrame):
-            extraction_table = extraction_table.to_pandas()
-        gff_table_bed = BedTool.from_dataframe(gff_table)
-        extraction_table_bed = BedTool.from_dataframe(extraction_table)
-
-        if faidx is not None:
-            gff_table_bed = gff_table_bed.sort(faidx=faidx)
-            extraction_table_bed = extraction_table_bed.sort(faidx=faidx)
-        else:
-            gff_table_bed = gff_table_bed.sort()
-            extraction_table_bed = extraction_table_bed.sort()
-
-        coverage_df = pl.read_csv(
-                                gff_table_bed.coverage(extraction_table_bed).fn,
-                                has_header=False,
-                                separator="\t",
-                                new_columns=gff_table.columns.tolist() + GFFExtractor.COVERAGE_FIELDS
-                                )\
+                            faidx: Optional[str] = None,
+                            by: Optional[list[str]] = None) -> pl.DataFrame:
+        """Coverage of the (merged) compartments by the extraction; with `group`, aggregated per
+        compartment and per group in `by`. The extraction is indexed once for all groups."""
+        if isinstance(gff_table, pd.DataFrame):
+            gff_table = pl.from_pandas(gff_table)
+        if isinstance(extraction_table, pd.DataFrame):
+            extraction_table = pl.from_pandas(extraction_table)
+        gff_table = GFFExtractor.sort_intervals(gff_table,
+                                                seqID_order=GFFExtractor.read_faidx(faidx) if faidx is not None else None,
+                                                by=by)
+
+        coverage_df = GFFExtractor.interval_coverage(gff_table, extraction_table)\
                         .with_columns(
                                 coverage=(1e6 * pl.col("coverage")),
                                 atLeastOne=(pl.col("totalHits") > 0).cast(pl.Int32)
@@ -266,7 +341,7 @@ class GFFExtractor:
                                 (pl.col("atLeastOne") * pl.col("counts")).alias("atLeastOneUnmerged")
                         )
         if group:
-            coverage_df = coverage_df.group_by("compartment",
+            coverage_df = coverage_df.group_by(["compartment"] + (by or []),
                                                maintain_order=True)\
                                     .agg(
                                             pl.col("totalHits").sum(),
@@ -402,71 +477,126 @@ class CoverageExtractor:
                 logging.info(f"Current progress for bucket `{self.bucket_id}`: {progress:.2f}.")
                 time.sleep(self.sleeping_time)
 
+    def process_accession(self, gff_file: str,
+                                reader: GFFExtractor,
+                                partition_col: Optional[str] = None,
+                                group: bool = True) -> Optional[pl.DataFrame]:
+        accession_id = extract_id(gff_file)
+        extraction_filename = self.extractions.get(accession_id)
+        if extraction_filename is None:
+            logging.info(f"Failed to find extraction file for accession id `{accession_id}`.")
+            return None
+        delimiter = CoverageExtractor._sniff_delimiter(extraction_filename)
+        extraction_table = pl.read_csv(extraction_filename, separator=delimiter)
+        extraction_table = extraction_table.rename({col: col[:1].lower() + col[1:] for col in extraction_table.columns})
+        if "seqID" not in extraction_table.columns:
+            if "chromosome" in extraction_table.columns:
+                extraction_table = extraction_table.rename({
+                                                        "chromosome": "seqID",
+                                                    })
+        if "seqID" not in extraction_table.columns:
+            raise KeyError(f"Invalid column for chromosome ID.")
+
+        selection_items = ["seqID", "start", "end"]
+        if partition_col is not None:
+            selection_items.append(partition_col)
+            if partition_col not in extraction_table.columns:
+                raise KeyError(f"Invalid partition column. `{partition_col}` was not found in the dataframe.")
+        extraction_table = extraction_table.select(selection_items)
+        gff_table = reader.read_gff(gff_file)
+        # one labelled copy per biotype; `.` keeps every compartment
+        gff_table = pl.concat([
+                        (gff_table if biotype == "." else gff_table.filter(pl.col("biotype") == biotype))
+                        .select(["seqID", "start", "end", "compartment"])
+                        .with_columns(pl.lit(biotype).alias("biotype"))
+                        for biotype in self.biotypes
+                    ])
+        # merge & resolve coverage for every (biotype, compartment) group at once
+        gff_table_merged = reader.merge(gff_table=gff_table, faidx=self.faidx, by=["biotype"])
+        coverage_table = reader.parse_coverage(
+                                                gff_table_merged,
+                                                extraction_table,
+                                                group=group,
+                                                faidx=self.faidx,
+                                                by=["biotype"])
+        return coverage_table.select(
+                                pl.exclude("biotype"),
+                                pl.lit(accession_id).alias("#assembly_accession"),
+                                pl.col("biotype")
+                            )
+
     def process_bucket(self, bucket_id: int, 
                             partition_col: Optional[str] = None, 
                             group: bool = True,
-                            sleeping_time: float = 200) -> None:
+                            sleeping_time: float = 200,
+                            workers: int = 1) -> None:
         bucket = self.load_bucket(bucket_id=bucket_id)
-        logging.info(f"Processing bucket `{bucket_id}`...")
-        reader = GFFExtractor(compartments=self.compartments)
-        coverage_df = []
-        unique_partitions = None
+        logging.info(f"Processing bucket `{bucket_id}` with {workers} workers...")
+        output = f"{self.out}/coverage_bucket_{bucket_id}.txt"
+        # finished accessions survive a killed job; a rerun only processes the remaining ones
+        checkpoint = BucketCheckpoint(output, signature={
+                                                "partition_col": partition_col,
+                                                "group": group,
+                                                "biotypes": self.biotypes,
+                                                "compartments": self.compartments,
+                                                "faidx": self.faidx,
+                                                })
+        pending = [gff_file for gff_file in bucket if not checkpoint.done(gff_file)]
         tracker = CoverageExtractor._TrackProgress(bucket_id=bucket_id,
                                                     total_records=len(bucket),
                                                     sleeping_time=sleeping_time)
+        tracker.track = len(bucket) - len(pending)
         daemon = threading.Thread(target=tracker.start, daemon=True, name="LoggingDaemon")
         daemon.start()
-        for gff_file in bucket:
-            tracker.track += 1
-            accession_id = extract_id(gff_file)
-            extraction_filename = self.extractions.get(accession_id)
-            if extraction_filename is None:
-                logging.info(f"Failed to find extraction file for accession id `{accession_id}`.")
-                continue
-            delimiter = CoverageExtractor._sniff_delimiter(extraction_filename)
-            extraction_table = pl.read_csv(extraction_filename, separator=delimiter)
-            extraction_table = extraction_table.rename({col: col[:1].lower() + col[1:] for col in extraction_table.columns})
-            if "seqID" not in extraction_table.columns:
-                if "chromosome" in extraction_table.columns:
-                    extraction_table = extraction_table.rename({
-                                                            "chromosome": "seqID",
-                                                        })
-            if "seqID" not in extraction_table.columns:
-                raise KeyError(f"Invalid column for chromosome ID.")
-
-            selection_items = ["seqID", "start", "end"]
-            if partition_col is not None:
-                selection_items.append(partition_col)
-                if partition_col not in extraction_table.columns:
-                    raise KeyError(f"Invalid partition column. `{partition_col}` was not found in the dataframe.")
-                unique_partitions = set(extraction_table[partition_col])
-            extraction_table = extraction_table.select(selection_items)
-            gff_table = reader.read_gff(gff_file)
-            for biotype in self.biotypes:
-                if biotype != ".":
-                    gff_table_temp = gff_table.filter(pl.col("biotype") == biotype)
-                else:
-                    gff_table_temp = gff_table
-                gff_table_merged = reader.merge(gff_table=gff_table_temp, faidx=self.faidx)
-                coverage_table = reader.parse_coverage(
-                                                        gff_table_merged, 
-                                                        extraction_table, 
-                                                        group=group, 
-                                                        faidx=self.faidx)\
-                                    .with_columns(
-                                            pl.lit(accession_id).alias("#assembly_accession"),
-                                            pl.lit(biotype).alias("biotype")
-                                        )
-                coverage_df.append(coverage_table)
-        coverage_df = pl.concat(coverage_df).sort(by=["#assembly_accession", "compartment", "biotype", "coverage"], 
-                                                  descending=True)
-        coverage_df.write_csv(f"{self.out}/coverage_bucket_{bucket_id}.txt",
+        if workers > 1:
+            # the design mapping & the GFF reader are set up once per worker;
+            # accessions come back as Arrow tables, collected by this process only
+            # workers are spawned: forking after polars started its thread pool can deadlock
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=_init_worker,
+                                           initargs=(self,))
+            results = executor.map(_process_accession,
+                                   pending,
+                                   [partition_col] * len(pending),
+                                   [group] * len(pending))
+        else:
+            executor = None
+            reader = GFFExtractor(compartments=self.compartments)
+            results = (self.process_accession(gff_file, reader, partition_col=partition_col, group=group) for gff_file in pending)
+        try:
+            for gff_file, coverage_table in zip(pending, results):
+                tracker.track += 1
+                if isinstance(coverage_table, pl.DataFrame):
+                    coverage_table = coverage_table.to_arrow()
+                checkpoint.save(gff_file, {"coverage": coverage_table})
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        coverage_df = pl.concat([pl.from_arrow(table) for table in checkpoint.load("coverage", bucket)])\
+                        .sort(by=["#assembly_accession", "compartment", "biotype", "coverage"], 
+                              descending=True)
+        coverage_df.write_csv(output,
                               separator="\t",
                               include_header=True,
                               float_precision=2
                               )
+        checkpoint.cleanup()
         logging.info(f"Bucket `{bucket_id}` has been processed succesfully.")
 
+_worker = {}
+
+def _init_worker(extractor: CoverageExtractor) -> None:
+    _worker.update(extractor=extractor,
+                   reader=GFFExtractor(compartments=extractor.compartments))
+
+def _process_accession(gff_file: str, partition_col: Optional[str], group: bool) -> Optional[pa.Table]:
+    coverage_table = _worker["extractor"].process_accession(gff_file,
+                                                            _worker["reader"],
+                                                            partition_col=partition_col,
+                                                            group=group)
+    return None if coverage_table is None else coverage_table.to_arrow()
+
 
 if __name__ == "__main__":
 
@@ -479,6 +609,7 @@ if __name__ == "__main__":
     parser.add_argument("--sleeping_time", type=float, default=200)
     parser.add_argument("--group", type=int, default=1)
     parser.add_argument("--partition_col", type=str, default=None)
+    parser.add_argument("--workers", type=int, default=1)
 
     args = parser.parse_args()
     out = Path(args.out).resolve()
@@ -508,5 +639,6 @@ if __name__ == "__main__":
     extractor.process_bucket(bucket_id=bucket_id, 
                              sleeping_time=sleeping_time, 
                              group=group, 
-                             partition_col=None)
+                             partition_col=None,
+                             workers=args.workers)
     print(colored(f"Process has been completed succesfully.", "green"))
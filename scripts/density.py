@@ -6,7 +6,9 @@ import pybedtools
 from mindi.coverage.gff_clean import GFFCleaner
 from mindi.coverage.pwm_density import PWMExtractor, strand_evaluators
 from mindi.coverage.windows_maker import WindowMaker
+from mindi.coverage.bootstrap import bootstrap_profiles
 from typing import Optional, Callable
+from dataclasses import dataclass, field
 from pathlib import Path
 
 GFF_FIELDS = ["seqID", 
@@ -37,17 +39,76 @@ def SUM(A_df: pd.DataFrame) -> int:
     return merge_and_read(A_df)\
             .assign(length=lambda ds: ds['end']-ds['start'])['length'].sum()
 
-def query(A_df: pd.DataFrame, 
-          B_df: pd.DataFrame, 
-          merge_A: bool = False,
-          merge_B: bool = False,
-          strand_B: bool = False) -> dict:
+def intersect(A_df: pd.DataFrame, B_df: pd.DataFrame) -> pd.DataFrame:
+    """In-memory equivalent of `bedtools intersect -a A -b B -wao` on sorted A & B.
+
+    Each chromosome is handled as a contiguous block of a single sorted key
+    (chromosome code, start), so that the candidate motifs of every target are
+    resolved with two `searchsorted` calls: motifs starting before the target end
+    and no earlier than the target start minus the longest motif.
+    """
+    A_columns = A_df.columns.tolist()
+    B_columns = B_df.columns.tolist()[3:]
+    codes, _ = pd.factorize(pd.concat([A_df.iloc[:, 0], B_df.iloc[:, 0]], ignore_index=True).astype(str), sort=True)
+    a_code, b_code = codes[:A_df.shape[0]].astype(np.int64), codes[A_df.shape[0]:].astype(np.int64)
+
+    # sort both tables by (chromosome, start, end)
+    a_order = np.lexsort((A_df.iloc[:, 2].to_numpy(), A_df.iloc[:, 1].to_numpy(), a_code))
+    b_order = np.lexsort((B_df.iloc[:, 2].to_numpy(), B_df.iloc[:, 1].to_numpy(), b_code))
+    A_df = A_df.iloc[a_order].reset_index(drop=True)
+    B_df = B_df.iloc[b_order].reset_index(drop=True)
+    a_code, b_code = a_code[a_order], b_code[b_order]
+    a_start = A_df.iloc[:, 1].to_numpy(dtype=np.int64)
+    a_end = A_df.iloc[:, 2].to_numpy(dtype=np.int64)
+    b_start = B_df.iloc[:, 1].to_numpy(dtype=np.int64)
+    b_end = B_df.iloc[:, 2].to_numpy(dtype=np.int64)
+
+    max_length = int((b_end - b_start).max()) if B_df.shape[0] > 0 else 0
+    span = int(max(a_end.max(initial=0), b_end.max(initial=0))) + max_length + 1
+    b_key = b_code * span + b_start
+    lower = np.searchsorted(b_key, a_code * span + a_start - max_length, side="right")
+    upper = np.searchsorted(b_key, a_code * span + a_end, side="left")
+
+    # expand candidate pairs & keep only the truly overlapping ones
+    candidates = np.maximum(upper - lower, 0)
+    a_idx = np.repeat(np.arange(A_df.shape[0]), candidates)
+    b_idx = np.repeat(lower, candidates) + np.arange(a_idx.shape[0]) \
+                - np.repeat(np.cumsum(candidates) - candidates, candidates)
+    hit = (b_code[b_idx] == a_code[a_idx]) & (b_end[b_idx] > a_start[a_idx]) & (b_start[b_idx] < a_end[a_idx])
+    a_idx, b_idx = a_idx[hit], b_idx[hit]
+    overlap = np.minimum(a_end[a_idx], b_end[b_idx]) - np.maximum(a_start[a_idx], b_start[b_idx])
+
+    matched_df = pd.concat([
+                        A_df.iloc[a_idx].reset_index(drop=True),
+                        B_df.iloc[b_idx].reset_index(drop=True)
+                            .set_axis(["chrom", "motif_start", "motif_end"] + B_columns, axis=1),
+                        ], axis=1)
+    matched_df["overlap"] = overlap
+    matched_df["_order"] = a_idx
+
+    # -wao reports targets without any overlap once, with null motif fields
+    unmatched = np.setdiff1d(np.arange(A_df.shape[0]), a_idx)
+    unmatched_df = A_df.iloc[unmatched].reset_index(drop=True)
+    for col in ["chrom"] + B_columns:
+        unmatched_df[col] = "."
+    unmatched_df["motif_start"] = -1
+    unmatched_df["motif_end"] = -1
+    unmatched_df["overlap"] = 0
+    unmatched_df["_order"] = unmatched
+
+    intersect_df = pd.concat([matched_df, unmatched_df], axis=0, ignore_index=True)
+    return intersect_df.sort_values(by="_order", kind="stable")\
+                        .drop(columns=["_order"])\
+                        .reset_index(drop=True)\
+                        [A_columns + ["chrom", "motif_start", "motif_end"] + B_columns + ["overlap"]]
+
+def intersect_bedtools(A_df: pd.DataFrame, 
+                       B_df: pd.DataFrame, 
+                       merge_A: bool = False,
+                       merge_B: bool = False,
+                       strand_B: bool = False) -> tuple[pd.DataFrame, int, int]:
     # to bed
     A_bed = BedTool.from_dataframe(A_df)
-    if "motif_strand" not in B_df:
-        B_df = B_df.rename(columns={"strand": "motif_strand"})
-    if "strand" in B_df:
-        B_df = B_df.drop(columns=["strand"])
     B_bed = BedTool.from_dataframe(B_df)
 
     # merge if applicable
@@ -63,7 +124,6 @@ def query(A_df: pd.DataFrame,
     B_bed = B_bed.sort()
 
     # fetch columns
-    A_columns = A_df.columns.tolist()
     B_columns = B_df.columns.tolist()[3:]
 
     # Calculate intersection between target: A_df and query: B_df
@@ -75,10 +135,75 @@ def query(A_df: pd.DataFrame,
                     + B_columns \
                     + ["overlap"]
         )
-    # total queries & targets
-    total_queries = A_bed.count()
-    total_targets = B_bed.count()
-    
+    return intersect_df, A_bed.count(), B_bed.count()
+
+def query(A_df: pd.DataFrame, 
+          B_df: pd.DataFrame, 
+          merge_A: bool = False,
+          merge_B: bool = False,
+          strand_B: bool = False,
+          engine: str = "numpy") -> dict:
+    if engine != "numpy" and engine != "bedtools":
+        raise ValueError(f"Invalid intersection engine `{engine}` detected.")
+    if "motif_strand" not in B_df:
+        B_df = B_df.rename(columns={"strand": "motif_strand"})
+    if "strand" in B_df:
+        B_df = B_df.drop(columns=["strand"])
+    A_columns = A_df.columns.tolist()
+
+    if engine == "bedtools":
+        # reference implementation; kept for differential testing
+        intersect_df, total_queries, total_targets = intersect_bedtools(A_df, B_df, 
+                                                                         merge_A=merge_A, 
+                                                                         merge_B=merge_B, 
+                                                                         strand_B=strand_B)
+    else:
+        if merge_A or merge_B:
+            raise ValueError("Merging of intervals is only supported by the `bedtools` engine.")
+        intersect_df = intersect(A_df, B_df)
+        # total queries & targets
+        total_queries = A_df.shape[0]
+        total_targets = B_df.shape[0]
+    return query_stats(intersect_df, 
+                       A_columns=A_columns, 
+                       total_queries=total_queries,
+                       total_targets=total_targets,
+                       total_motifs=B_df.shape[0],
+                       strand_B=strand_B)
+
+def query_sites(sites: dict[str, pd.DataFrame], 
+                B_df: pd.DataFrame, 
+                strand_B: bool = False) -> dict[str, dict]:
+    """Queries several anchor sets (e.g. TSS & TES windows) against B in a single sweep.
+
+    The anchor sets are stacked into one target table, so that the motifs are sorted
+    once and all windows are resolved by one intersection; the query statistics are
+    then computed separately for each site.
+    """
+    if "motif_strand" not in B_df:
+        B_df = B_df.rename(columns={"strand": "motif_strand"})
+    if "strand" in B_df:
+        B_df = B_df.drop(columns=["strand"])
+    A_df = pd.concat([A_site.assign(site=site) for site, A_site in sites.items()], 
+                     axis=0, 
+                     ignore_index=True)
+    intersect_df = intersect(A_df, B_df)
+    site_queries = {}
+    for site, A_site in sites.items():
+        site_queries[site] = query_stats(intersect_df[intersect_df["site"] == site].drop(columns=["site"]),
+                                         A_columns=A_site.columns.tolist(),
+                                         total_queries=A_site.shape[0],
+                                         total_targets=B_df.shape[0],
+                                         total_motifs=B_df.shape[0],
+                                         strand_B=strand_B)
+    return site_queries
+
+def query_stats(intersect_df: pd.DataFrame, 
+                A_columns: list[str],
+                total_queries: int,
+                total_targets: int,
+                total_motifs: int,
+                strand_B: bool = False) -> dict:
     # Estimate:
     # - total number of compartments from A (unique)
     # - the percentage that have at least one overlap
@@ -114,7 +239,6 @@ def query(A_df: pd.DataFrame,
     # intersect_df = intersect_df.query("overlap > 0")
 
     # Calculate Number of motifs from B mapped to A
-    total_motifs = B_df.shape[0]
     # keep compartments from A succesfully mapped to an element of B
     # drop duplicates to ensure that a query from B has not been mapped to more 
     # than one compartment from A; since here we are only interested to estimate 
@@ -171,22 +295,23 @@ def bootstrap(intersect_df: pd.DataFrame,
               N: int = 1_000,
               lower_q: float = 0.025,
               upper_q: float = 0.975,
+              rng: Optional[np.random.Generator] = None,
+              cluster_columns: Optional[list[str]] = None,
+              total_clusters: Optional[int] = None,
               ) -> tuple[pd.Series, pd.Series, pd.Series]:
-    bootstrapped_df = []
     extractor = PWMExtractor()
-    for _ in range(N):
-        sample_df = intersect_df.sample(frac=1.0, replace=True)
-        density = extractor.extract_density(sample_df, 
-                                            window_size=window_size,
-                                            return_array=True,
-                                            enrichment=True
-                                            )
-        bootstrapped_df.append(density)
-    bootstrapped_df = pd.DataFrame(bootstrapped_df)
-    average = bootstrapped_df.mean()
-    ci_lower = bootstrapped_df.quantile(lower_q)
-    ci_upper = bootstrapped_df.quantile(upper_q)
-    return average, ci_lower, ci_upper
+    if cluster_columns is not None:
+        # resample whole windows (genes) instead of single intersections
+        matrix = extractor.cluster_matrix(intersect_df, window_size, cluster_columns, total_clusters)
+    else:
+        matrix = extractor.difference_matrix(intersect_df, window_size)
+    average, ci_lower, ci_upper = bootstrap_profiles(matrix,
+                                                     N=N,
+                                                     lower_q=lower_q,
+                                                     upper_q=upper_q,
+                                                     rng=rng,
+                                                     cumulative=True)
+    return pd.Series(average), pd.Series(ci_lower), pd.Series(ci_upper)
 
 def relative_density(A_file: str, 
                      B_file: str,
@@ -225,6 +350,100 @@ def determine_strand(seq: str) -> str:
         return "+"
     return "-"
 
+@dataclass
+class AccessionContext:
+    """Accession-scoped cache of the parsed extraction, the parsed GFF and the TSS/TES windows.
+
+    Enrichment extraction loops over every (biotype x partition) combination of the same 
+    accession; with a shared context the files are read & parsed once per accession.
+    """
+
+    extraction: str
+    gff_file: str
+    genome: Optional[str] = None
+    _extractions: dict = field(default_factory=dict, init=False, repr=False)
+    _compartments: dict = field(default_factory=dict, init=False, repr=False)
+    _windows: dict = field(default_factory=dict, init=False, repr=False)
+
+    def read_extractions(self, 
+                         mode: str = "density", 
+                         determine_strand: Optional[Callable[[str], str]] = None) -> Optional[pd.DataFrame]:
+        if mode in self._extractions:
+            return self._extractions[mode]
+        if "raw" not in self._extractions:
+            self._extractions["raw"] = self._read_extractions()
+        extractions_df = self._extractions["raw"]
+        if extractions_df is not None and mode == "template":
+            if "strand" not in extractions_df and "sequence" not in extractions_df:
+                raise KeyError(f"Either `strand` or `sequence` must be present in the dataframe when selected mode is `template`.")
+            if "strand" not in extractions_df:
+                # resolve strand if sequence is present when mode is `template`
+                extractions_df = extractions_df.copy()
+                extractions_df["strand"] = extractions_df["sequence"].str.lower().apply(determine_strand)
+        self._extractions[mode] = extractions_df
+        return extractions_df
+
+    def _read_extractions(self) -> Optional[pd.DataFrame]:
+        extraction = self.extraction
+        delimiter = sniff_delimiter(extraction)
+        try:
+            extractions_df = pd.read_csv(extraction, sep=delimiter, comment="#")
+            extractions_df.columns = [col[0].lower() + col[1:] for col in extractions_df.columns]
+        except pd.errors.EmptyDataError:
+            return None
+        # change column names to match
+        if "seqID" not in extractions_df:
+            extractions_df = extractions_df.rename(columns={"chromosome": "seqID", 
+                                                            "Chromosome": "seqID", 
+                                                            "sequence_name": "seqID", 
+                                                            "sequenceName": "seqID"})
+        if "seqID" not in extractions_df:
+            raise KeyError(f"Column `seqID` is not present in the extractions dataframe ({extraction}).")
+        if "end" not in extractions_df:
+            extractions_df = extractions_df.rename(columns={"stop": "end", 
+                                                            "Stop": "end", 
+                                                            "End": "end"})
+        if "end" not in extractions_df:
+            raise KeyError(f"Column `end` is not present in the extractions dataframe ({extraction}).")
+        return extractions_df
+
+    def read_compartments(self, compartment: str, biotype: Optional[str] = None) -> pd.DataFrame:
+        key = (compartment, biotype is not None)
+        if key not in self._compartments:
+            cleaner = GFFCleaner(valid_compartments=[compartment])
+            self._compartments[key] = cleaner.read_gff(self.gff_file, 
+                                                       post_filter=[compartment],
+                                                       change_names=True,
+                                                       biotype=biotype is not None, 
+                                                       parse_name=True)
+        gff_df = self._compartments[key]
+        if biotype:
+            gff_df = gff_df.query(f"biotype == '{biotype}'")
+            gff_df = gff_df[["seqID", "start", "end", "biotype", "name", "strand"]]
+        else:
+            gff_df = gff_df[["seqID", "start", "end", "name", "strand"]]
+        return gff_df
+
+    def windows(self, 
+                compartment: str, 
+                window_size: int, 
+                biotype: Optional[str] = None) -> Optional[tuple[pd.DataFrame, pd.DataFrame]]:
+        """Returns the TSS & TES windows of the compartment; None when the GFF has no such compartments."""
+        key = (compartment, biotype, window_size)
+        if key in self._windows:
+            return self._windows[key]
+        gff_df = self.read_compartments(compartment, biotype=biotype)
+        if gff_df.shape[0] == 0:
+            self._windows[key] = None
+            return None
+        maker = WindowMaker(base=0, window_size=window_size)
+        # Transcription Start Site (TSS) from GFF
+        gff_tss = maker.make_windows(gff_df, loci="start", genome=self.genome)
+        # Transcription End Site (TES) from GFF
+        gff_tes = maker.make_windows(gff_df, loci="end", genome=self.genome)
+        self._windows[key] = (gff_tss, gff_tes)
+        return self._windows[key]
+
 def extract_density(extraction: str,
                     gff_file: str,
                     window_size: int,
@@ -237,6 +456,8 @@ def extract_density(extraction: str,
                     tempdir: Optional[str] = None,
                     biotype: Optional[str] = None,
                     genome: Optional[str] = None,
+                    single_sweep: bool = True,
+                    context: Optional[AccessionContext] = None,
                     ) -> Optional[dict]:
     global GFF_FIELDS
     if tempdir is not None:
@@ -244,33 +465,11 @@ def extract_density(extraction: str,
         pybedtools.set_tempdir(tempdir)
     if mode != "template" and mode != "density":
         raise ValueError(f"Invalid mode `{mode}` detected.")
-    maker = WindowMaker(base=0, window_size=window_size)
-    cleaner = GFFCleaner(valid_compartments=[compartment])
-    delimiter = sniff_delimiter(extraction)
-    try:
-        extractions_df = pd.read_csv(extraction, sep=delimiter, comment="#")
-        extractions_df.columns = [col[0].lower() + col[1:] for col in extractions_df.columns]
-    except pd.errors.EmptyDataError:
+    if context is None:
+        context = AccessionContext(extraction=extraction, gff_file=gff_file, genome=genome)
+    extractions_df = context.read_extractions(mode=mode, determine_strand=determine_strand)
+    if extractions_df is None:
         return None
-    # change column names to match
-    if "seqID" not in extractions_df:
-        extractions_df = extractions_df.rename(columns={"chromosome": "seqID", 
-                                                        "Chromosome": "seqID", 
-                                                        "sequence_name": "seqID", 
-                                                        "sequenceName": "seqID"})
-    if "seqID" not in extractions_df:
-        raise KeyError(f"Column `seqID` is not present in the extractions dataframe ({extraction}).")
-    if "end" not in extractions_df:
-        extractions_df = extractions_df.rename(columns={"stop": "end", 
-                                                        "Stop": "end", 
-                                                        "End": "end"})
-    if "end" not in extractions_df:
-        raise KeyError(f"Column `end` is not present in the extractions dataframe ({extraction}).")
-    if "strand" not in extractions_df and "sequence" not in extractions_df and mode == "template":
-        raise KeyError(f"Either `strand` or `sequence` must be present in the dataframe when selected mode is `template`.")
-    if "strand" not in extractions_df and mode == "template":
-        # resolve strand if sequence is present when mode is `template`
-        extractions_df["strand"] = extractions_df["sequence"].str.lower().apply(determine_strand)
 
     if attribute != "all" and attribute_col:
         if attribute_col not in extractions_df:
@@ -283,22 +482,13 @@ def extract_density(extraction: str,
     else:
         extractions_df = extractions_df[["seqID", "start", "end"]]
 
-    gff_df = cleaner.read_gff(gff_file, 
-                              post_filter=[compartment],
-                              change_names=True,
-                              biotype=biotype is not None, 
-                              parse_name=True)
-    if biotype:
-        gff_df = gff_df.query(f"biotype == '{biotype}'")
-        gff_df = gff_df[["seqID", "start", "end", "biotype", "name", "strand"]]
-    else:
-        gff_df = gff_df[["seqID", "start", "end", "name", "strand"]]
-    
+    windows = context.windows(compartment, window_size=window_size, biotype=biotype)
     # handle that some GFF files may not have genes or other compartments
-    if gff_df.shape[0] == 0:
+    if windows is None:
         # in this case return None, since we cannot make a statistical assesement abou the density
         # there are no compartments to make such assesement
         return None
+    gff_tss, gff_tes = windows
    
     # return query statistics for template & non template query matches
     if mode == "template":
@@ -306,9 +496,12 @@ def extract_density(extraction: str,
     else:
         strand_B = False
 
-    # Transcription Start Site (TSS) from GFF
-    gff_tss = maker.make_windows(gff_df, loci="start", genome=genome)
-    tss_query = query(gff_tss, extractions_df, strand_B=strand_B)
+    if single_sweep:
+        site_queries = query_sites({"tss": gff_tss, "tes": gff_tes}, extractions_df, strand_B=strand_B)
+        tss_query, tes_query = site_queries["tss"], site_queries["tes"]
+    else:
+        tss_query = query(gff_tss, extractions_df, strand_B=strand_B)
+        tes_query = query(gff_tes, extractions_df, strand_B=strand_B)
     intersect_tss = tss_query.pop("intersect")
 
     # REPLACE with query function >>>>
@@ -319,9 +512,6 @@ def extract_density(extraction: str,
     #                         names=GFF_FIELDS)
     # REPLACE with query function <<<<
 
-    # Transcription End Site (TES) from GFF
-    gff_tes = maker.make_windows(gff_df, loci="end", genome=genome)
-    tes_query = query(gff_tes, extractions_df, strand_B=strand_B)
     intersect_tes = tes_query.pop("intersect")
 
     # REPLACE with query function >>>>
@@ -357,7 +547,9 @@ def extract_density(extraction: str,
     for site, intersect_df in zip(["tss", "tes"], [intersect_tss, intersect_tes]):
         density = _extract_density(intersect_df, mode)
         density = density.astype(int)
-        density = density.set_index("index").T
+        if mode == "density":
+            # template densities are already stacked by strand (template|non_template)
+            density = density.set_index("index").T
         density.loc[:, "site"] = site
         densities_df.append(density)
         queries_df = pd.DataFrame(site_queries[site], index=[0]).T\
@@ -373,6 +565,177 @@ def extract_density(extraction: str,
     return densities_df, stats_df
 
 
+def extract_grouped_density(context: AccessionContext,
+                            window_size: int | list[int],
+                            mode: str = "density",
+                            enrichment: bool = False,
+                            compartment: str = "Gene",
+                            determine_strand: Optional[Callable[[str], str]] = None,
+                            attribute_col: str = "partition",
+                            attributes: Optional[list] = None,
+                            biotypes: Optional[list[Optional[str]]] = None,
+                            bin_size: int = 1,
+                            ) -> Optional[tuple[pd.DataFrame, pd.DataFrame]]:
+    """Grouped equivalent of calling `extract_density` for every (biotype, attribute) combination.
+
+    The windows of all biotypes & sites are intersected once against all motifs; 
+    each intersection is then accumulated into the profile of its (site, biotype, partition)
+    group in a single pass. Returns the stacked densities & query statistics tables,
+    keyed by `site`, `biotype` and `attribute_col`.
+
+    When a list of window sizes is provided, the intersection is computed once at the largest 
+    window and trimmed to each nested smaller window; both tables then carry a `window_size` key.
+    Profiles are aggregated into bins of `bin_size` positions (see `PWMExtractor.profile_bins`).
+    """
+    if mode != "template" and mode != "density":
+        raise ValueError(f"Invalid mode `{mode}` detected.")
+    if attributes is None:
+        attributes = ["all"]
+    if biotypes is None:
+        biotypes = [None]
+    multi_window = isinstance(window_size, (list, tuple))
+    window_sizes = sorted(set(window_size), reverse=True) if multi_window else [window_size]
+    max_window_size = window_sizes[0]
+    positions = {window: PWMExtractor.profile_positions(window, bin_size) for window in window_sizes}
+    extractions_df = context.read_extractions(mode=mode, determine_strand=determine_strand)
+    if extractions_df is None:
+        return None
+
+    # partition code of each motif; motifs outside the requested partitions only count towards `all`
+    partitions = [attribute for attribute in attributes if attribute != "all"]
+    total_partitions = len(partitions)
+    if total_partitions > 0 and attribute_col not in extractions_df:
+        raise KeyError(f"Column `{attribute_col}` is not present in the extractions dataframe ({context.extraction}).")
+    if mode == "template":
+        B_df = extractions_df[["seqID", "start", "end", "sequence", "strand"]]\
+                                .rename(columns={"strand": "motif_strand"})
+    else:
+        B_df = extractions_df[["seqID", "start", "end"]]
+    if total_partitions > 0:
+        partition_code = extractions_df[attribute_col].map({p: k for k, p in enumerate(partitions)})\
+                                                      .fillna(total_partitions)\
+                                                      .astype(int)
+    else:
+        partition_code = total_partitions
+    B_df = B_df.assign(partition_code=partition_code)
+    total_targets = np.bincount(B_df["partition_code"], minlength=total_partitions + 1)
+
+    # stack the windows of every (site, biotype) group into one target table
+    groups, A_df = [], []
+    for biotype in biotypes:
+        windows = context.windows(compartment, window_size=max_window_size, biotype=biotype)
+        if windows is None:
+            continue
+        for site, gff_windows in zip(["tss", "tes"], windows):
+            A_columns = gff_windows.columns.tolist()
+            A_df.append(gff_windows[["seqID", "start", "end", "strand"]]\
+                            .assign(group=len(groups),
+                                    # groupby key of query statistics; NaN keys are dropped as in `query`
+                                    key=gff_windows.groupby(A_columns, dropna=True, sort=False).ngroup().to_numpy(),
+                                    )
+                        )
+            groups.append((site, biotype, gff_windows.shape[0]))
+    if len(groups) == 0:
+        return None
+    A_df = pd.concat(A_df, axis=0, ignore_index=True)
+    total_keys = A_df[A_df["key"] >= 0].groupby("group")["key"].nunique()\
+                                       .reindex(range(len(groups)), fill_value=0)
+    intersect_df = intersect(A_df, B_df)
+    hits = intersect_df[intersect_df["overlap"] > 0].copy()
+    hits["motif"] = hits.groupby(["chrom", "motif_start", "motif_end"], sort=False).ngroup()
+    hits["key"] = hits["key"].where(hits["key"] >= 0)
+    if mode == "template":
+        assert determine_strand is not None, f"Determine strand callable was not provided."
+        hits["non_template"] = (hits["strand"] == hits["motif_strand"]).astype(int)
+        # profiles are split on the strand resolved from the motif sequence
+        hits["profile_non_template"] = (hits["strand"] == hits["sequence"].str.lower().apply(determine_strand)).astype(int)
+        strand_types = ["template", "non_template"]
+    else:
+        hits["non_template"] = np.nan
+        strand_types = [None]
+    group_ids = {(site, biotype): group for group, (site, biotype, _) in enumerate(groups)}
+    name = "Enrichment" if enrichment else "Occurrences"
+    pwm = PWMExtractor()
+
+    densities_df, stats_df = [], []
+    for window in window_sizes:
+        window_hits = pwm.restrict_window(hits, window, max_window_size)
+
+        # >> query statistics of every (group, partition) & every group (`all`)
+        aggregations = dict(matched_targets=("motif", "nunique"),
+                            matched_keys=("key", "nunique"),
+                            non_template=("non_template", "mean"))
+        partition_stats = window_hits.groupby(["group", "partition_code"]).agg(**aggregations)
+        group_stats = window_hits.groupby("group").agg(**aggregations)
+
+        def _query_stats(group: int, partition: Optional[int]) -> dict:
+            stats = group_stats if partition is None else partition_stats
+            index = group if partition is None else (group, partition)
+            matched_targets, matched_keys, non_template = stats.loc[index] if index in stats.index else (0, 0, np.nan)
+            site_targets = int(total_targets.sum() if partition is None else total_targets[partition])
+            total_queries = groups[group][2]
+            zero_keys = int(total_keys[group]) - int(matched_keys)
+            matched_queries = total_queries - zero_keys if zero_keys > 0 else int(matched_keys)
+            if mode == "template" and not np.isnan(non_template):
+                matched_targets_non_template = round(1e2 * non_template, 2)
+                matched_targets_template = round(1e2 - matched_targets_non_template, 2)
+            else:
+                matched_targets_non_template, matched_targets_template = None, None
+            return {
+                    "total_targets": site_targets,
+                    "matched_targets": int(matched_targets),
+                    "matched_targets_non_template": matched_targets_non_template,
+                    "matched_targets_template": matched_targets_template,
+                    "target_perc": round(1e2 * matched_targets / site_targets, 2) if site_targets > 0 else None,
+                    "total_queries": total_queries,
+                    "matched_queries": matched_queries,
+                    "query_perc": round(1e2 * matched_queries / total_queries, 2) if total_queries > 0 else None,
+                    }
+        # <<
+
+        # >> profiles of every (group, partition[, template|non_template]) in one pass
+        window_hits = window_hits[window_hits["strand"] != "?"]
+        profile_id = window_hits["group"].to_numpy(dtype=np.int64) * (total_partitions + 1) \
+                        + window_hits["partition_code"].to_numpy(dtype=np.int64)
+        if mode == "template":
+            profile_id = 2 * profile_id + window_hits["profile_non_template"].to_numpy(dtype=np.int64)
+        L, U, _ = pwm.relative_offsets(window_hits, window)
+        profiles = pwm.accumulate_profiles(L, U, window,
+                                           groups=profile_id,
+                                           total_groups=len(groups) * (total_partitions + 1) * len(strand_types))\
+                      .reshape(len(groups), total_partitions + 1, len(strand_types), 2 * window + 1)
+        profiles = pwm.bin_profiles(profiles, bin_size=bin_size)
+        # <<
+
+        for biotype in biotypes:
+            for attribute in attributes:
+                partition = None if attribute == "all" else partitions.index(attribute)
+                for site in ["tss", "tes"]:
+                    group = group_ids.get((site, biotype))
+                    if group is None:
+                        continue
+                    profile = profiles[group].sum(axis=0) if partition is None else profiles[group][partition]
+                    if enrichment:
+                        profile = profile / profile.mean(axis=1, keepdims=True)
+                    density = pd.DataFrame(profile, columns=positions[window])
+                    density.insert(0, attribute_col, attribute)
+                    density.insert(0, "biotype", biotype if biotype else ".")
+                    density.insert(0, "site", site)
+                    stats = _query_stats(group, partition)
+                    stats.update({"site": site, attribute_col: attribute, "biotype": biotype if biotype else "."})
+                    if multi_window:
+                        density.insert(0, "window_size", window)
+                        stats.update({"window_size": window})
+                    if mode == "template":
+                        density.insert(0, "template|non_template", [f"{name}_{typ}" for typ in strand_types])
+                    densities_df.append(density)
+                    stats_df.append(stats)
+    # smaller windows are left empty (NaN) outside of their range
+    densities_df = pd.concat(densities_df, axis=0, ignore_index=True)
+    stats_df = pd.DataFrame(stats_df)
+    stats_df = stats_df[["site"] + [col for col in stats_df.columns if col != "site"]]
+    return densities_df, stats_df
+
 if __name__ == "__main__":
     import sys
     import matplotlib.pyplot as plt
@@ -2,6 +2,8 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from plotly import graph_objs
 import polars as pl
+import pyarrow.parquet as pq
+import json
 from termcolor import colored
 
 class DensityPlotter(object):
@@ -30,6 +32,12 @@ class DensityPlotter(object):
     def _load_densities(self):
         self.tss_densities = pl.read_parquet(self.tss_path).drop(['biotype', 'generic'])
         self.tes_densities = pl.read_parquet(self.tes_path).drop(['biotype', 'generic'])
+        # binned profiles record their bin edges and are labelled by the centre of each bin
+        metadata = pq.read_schema(self.tss_path).metadata or {}
+        bin_size = int(metadata.get(b"bin_size", 1))
+        if bin_size > 1:
+            bin_edges = json.loads(metadata[b"bin_edges"])[str(self.window_size)]
+            self.xrange = [edge + bin_size // 2 for edge in bin_edges[:-1]]
 
     def get_tss_tes(self, assembly_id: str) -> tuple:
         df_tss = self.tss_densities.filter(pl.col("#assembly_accession") == assembly_id).drop(['#assembly_accession']).sum()
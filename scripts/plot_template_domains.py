@@ -41,7 +41,7 @@ if __name__ == "__main__":
     groups = tss_files.keys()
 
     def load_density(site: str) -> pd.DataFrame:
-        df = pd.read_csv(site, index_col=0)
+        df = pd.read_csv(site, index_col=0).drop(columns=["iterations"], errors="ignore")
         df["typ"] = df.index.map(lambda x: x.split("_")[2])
         df["biotype"] = df.index.map(lambda x: x.split("_")[3])
         return df
@@ -2,10 +2,12 @@ import numpy as np
 import pandas as pd
 from typing import Callable, Optional
 from abc import abstractmethod 
-from tqdm import tqdm
+from scipy import sparse
 import matplotlib.pyplot as plt
 from seaborn import color_palette
 
+from mindi.coverage.bootstrap import bootstrap_profiles
+
 class StrandEvaluator:
     @abstractmethod
     def determine_strand(self, motif: str) -> str:
@@ -59,10 +61,7 @@ class PWMExtractor:
             return "non_template"
         return "template"
 
-    def extract_template_density(self, intersect_df: pd.DataFrame, 
-                                        window_size: int, 
-                                        enrichment: bool = False,
-                                 ) -> pd.DataFrame:
+    def _iterate_template_density(self, intersect_df: pd.DataFrame, window_size: int) -> tuple[dict[str, np.ndarray], int]:
         total_counts = {
                         "template": np.zeros(2*window_size+1),
                         "non_template": np.zeros(2*window_size+1)
@@ -97,6 +96,24 @@ class PWMExtractor:
                 if compartment_strand == "-":
                     temp_counts = temp_counts[::-1]
                 total_counts[template] += temp_counts
+        return total_counts, total_overlap
+
+    def extract_template_density(self, intersect_df: pd.DataFrame, 
+                                        window_size: int, 
+                                        enrichment: bool = False,
+                                        vectorized: bool = True,
+                                 ) -> pd.DataFrame:
+        if vectorized:
+            intersect_df = intersect_df[intersect_df["strand"] != "?"]
+            # non-template strand: motif lies on the same strand as the compartment
+            non_template = (intersect_df["strand"] == intersect_df["motif_strand"]).to_numpy().astype(np.int64)
+            L, U, total_overlap = self.relative_offsets(intersect_df, window_size)
+            profiles = self.accumulate_profiles(L, U, window_size, 
+                                                groups=non_template, 
+                                                total_groups=2).astype(float)
+            total_counts = {"template": profiles[0], "non_template": profiles[1]}
+        else:
+            total_counts, total_overlap = self._iterate_template_density(intersect_df, window_size)
 
         # honour contract
         assert total_overlap == np.sum(total_counts["template"]) + np.sum(total_counts["non_template"]), f"Overlap: {total_overlap} vs. Calculated overlap {np.sum(total_counts)}."
@@ -133,58 +150,48 @@ class PWMExtractor:
 
     def get_relative_positions(self, 
                                intersect_df: pd.DataFrame, 
-                               window_size: int) -> pd.DataFrame:
-        relative_df = []
-        total_overlap = 0
-        for _, row in intersect_df.iterrows():
-                compartment_strand = row['strand']
-                if compartment_strand == "?":
-                    continue
-                start = int(row['start'])
-                end = int(row['end'])
-                motif_start = int(row['motif_start'])
-                motif_end = int(row['motif_end'])
-
-                temp_counts = np.zeros(2*window_size+1)
-                overlap = int(row['overlap'])
-                total_overlap += overlap
-                origin = end - window_size - 1
-                L = max(0, window_size - (origin - motif_start))
-                U = min(2 * window_size + 1, window_size - (origin - motif_end))
-
-                assert L <= U
-                overlap_start = max(motif_start, start)
-                overlap_end = min(motif_end, end)
-                overlap_length = overlap_end - overlap_start
-                assert overlap == overlap_length
-                assert overlap == U-L
-                temp_counts[L:U] += 1
-
-                if compartment_strand == "-":
-                    temp_counts = temp_counts[::-1]
-                relative_df.append(list(temp_counts))
-        relative_df = pd.DataFrame(relative_df, 
-                                   columns=range(-window_size, window_size+1))
-        total_sum = float(relative_df.values.sum())
+                               window_size: int,
+                               return_sparse: bool = True) -> sparse.csr_matrix | pd.DataFrame:
+        """Strand-aware 0/1 coverage of the 2w+1 window positions for every resolved intersection.
+
+        The (intersections x 2w+1) CSR matrix is built directly from the [L, U) offsets,
+        so memory scales with the total overlap instead of intersections x window width.
+        It is returned as is (and taken as is by `bootstrap`); `return_sparse=False` densifies it into a
+        DataFrame, e.g. for plotting.
+        Intersections with an unresolved strand ('?') are skipped.
+        """
+        L, U, total_overlap = self.relative_offsets(intersect_df, window_size)
+        lengths = U - L
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        # consecutive columns L, L+1, ..., U-1 of every row
+        indices = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - L, lengths)
+        relative_positions = sparse.csr_matrix((np.ones(indptr[-1]), indices, indptr),
+                                               shape=(L.shape[0], 2 * window_size + 1))
+        total_sum = float(relative_positions.sum())
         assert total_overlap == total_sum, f"Overlap: {total_overlap} vs. Calculated overlap {total_sum}."
-        return relative_df
+        if return_sparse:
+            return relative_positions
+        return pd.DataFrame(relative_positions.toarray(), 
+                            columns=range(-window_size, window_size+1))
 
-    def bootstrap(self, relative_positions: pd.DataFrame, 
+    def bootstrap(self, relative_positions: sparse.csr_matrix | pd.DataFrame, 
                   N: int = 1_000,
                   lower_quantile: float = 0.025,
-                  upper_quantile: float = 0.975) -> tuple[pd.Series, pd.Series, pd.Series]:
-        bootstrap_df = []
-        total_samples = relative_positions.shape[0]
-        for _ in tqdm(range(N), leave=True, position=0):
-            density = relative_positions.sample(total_samples, replace=True)\
-                                        .sum(axis=0)
-            density /= np.mean(density)
-            bootstrap_df.append(density)
-        bootstrap_df = pd.DataFrame(bootstrap_df)
-        average = bootstrap_df.mean()
-        lower_bound = bootstrap_df.quantile(lower_quantile)
-        upper_bound = bootstrap_df.quantile(upper_quantile)
-        return average, lower_bound, upper_bound
+                  upper_quantile: float = 0.975,
+                  rng: Optional[np.random.Generator] = None) -> tuple[pd.Series, pd.Series, pd.Series]:
+        if sparse.issparse(relative_positions):
+            window_size = (relative_positions.shape[1] - 1) // 2
+            matrix, columns = relative_positions, range(-window_size, window_size+1)
+        else:
+            matrix, columns = relative_positions.to_numpy(dtype=float), relative_positions.columns
+        average, lower_bound, upper_bound = bootstrap_profiles(matrix,
+                                                               N=N,
+                                                               lower_q=lower_quantile,
+                                                               upper_q=upper_quantile,
+                                                               rng=rng)
+        return pd.Series(average, index=columns), \
+                pd.Series(lower_bound, index=columns), \
+                pd.Series(upper_bound, index=columns)
             
     def plot_density(self, 
                      density, 
@@ -269,12 +276,142 @@ class PWMExtractor:
         ax.tick_params(axis="both", labelsize=13)
         return fig, ax
         
-    def extract_density(self, intersect_df: pd.DataFrame, 
-                        window_size: int,
-                        return_array: bool = True,
-                        return_frame: bool = False,
-                        enrichment: bool = False,
-                        ) -> list[int] | np.ndarray:
+    def relative_offsets(self, 
+                         intersect_df: pd.DataFrame, 
+                         window_size: int) -> tuple[np.ndarray, np.ndarray, int]:
+        """Computes the [L, U) profile offsets of every intersection in one batch.
+
+        Offsets of compartments on the negative strand are mirrored around the origin,
+        so that [L, U) can be accumulated directly into the strand-aware profile.
+        Returns the L & U arrays together with the total overlap of the intersections.
+        """
+        intersect_df = intersect_df[intersect_df["strand"] != "?"]
+        start = intersect_df["start"].to_numpy(dtype=np.int64)
+        end = intersect_df["end"].to_numpy(dtype=np.int64)
+        motif_start = intersect_df["motif_start"].to_numpy(dtype=np.int64)
+        motif_end = intersect_df["motif_end"].to_numpy(dtype=np.int64)
+        overlap = intersect_df["overlap"].to_numpy(dtype=np.int64)
+        negative = (intersect_df["strand"] == "-").to_numpy()
+
+        origin = end - window_size - 1
+        L = np.maximum(0, window_size - (origin - motif_start))
+        U = np.minimum(2 * window_size + 1, window_size - (origin - motif_end))
+
+        # honour the same per-row contract as the iterative extraction
+        assert np.all(L <= U)
+        overlap_length = np.minimum(motif_end, end) - np.maximum(motif_start, start)
+        assert np.array_equal(overlap, overlap_length), f"Overlap mismatch at rows {np.flatnonzero(overlap != overlap_length)}."
+        assert np.array_equal(overlap, U - L), f"Overlap mismatch at rows {np.flatnonzero(overlap != U - L)}."
+
+        L, U = np.where(negative, 2 * window_size + 1 - U, L), np.where(negative, 2 * window_size + 1 - L, U)
+        return L, U, int(overlap.sum())
+
+    @staticmethod
+    def accumulate_profiles(L: np.ndarray, 
+                            U: np.ndarray, 
+                            window_size: int,
+                            groups: Optional[np.ndarray] = None,
+                            total_groups: int = 1) -> np.ndarray:
+        """Accumulates the [L, U) offsets into one profile per group with a difference array."""
+        # one extra column absorbs the closing edges at U = 2w+1
+        width = 2 * window_size + 2
+        if groups is None:
+            groups = np.zeros(L.shape[0], dtype=np.int64)
+        diff = np.bincount(groups * width + L, minlength=total_groups * width) \
+                - np.bincount(groups * width + U, minlength=total_groups * width)
+        return np.cumsum(diff.reshape(total_groups, width), axis=1)[:, :-1]
+
+    def difference_matrix(self, 
+                          intersect_df: pd.DataFrame, 
+                          window_size: int) -> sparse.csr_matrix:
+        """Sparse (intersections x 2w+2) matrix with +1 at L & -1 at U of every intersection.
+
+        Integrating (cumsum) any weighted sum of its rows yields the weighted profile;
+        intersections with an unresolved strand ('?') are kept as empty rows.
+        """
+        rows = np.flatnonzero((intersect_df["strand"] != "?").to_numpy())
+        L, U, _ = self.relative_offsets(intersect_df, window_size)
+        data = np.concatenate([np.ones(rows.shape[0]), -np.ones(rows.shape[0])])
+        return sparse.csr_matrix((data, (np.concatenate([rows, rows]), np.concatenate([L, U]))),
+                                 shape=(intersect_df.shape[0], 2 * window_size + 2))
+
+    def cluster_matrix(self, 
+                       intersect_df: pd.DataFrame, 
+                       window_size: int,
+                       cluster_columns: Optional[list[str]] = None,
+                       total_clusters: Optional[int] = None) -> sparse.csr_matrix:
+        """Sparse (clusters x 2w+2) difference matrix summing the intersections of every cluster (e.g. gene window).
+
+        Clusters are keyed by `cluster_columns` (the window coordinates by default) in order of appearance;
+        `total_clusters` pads empty rows for the windows without any intersection.
+        """
+        if cluster_columns is None:
+            cluster_columns = ["seqID", "start", "end", "strand"]
+        clusters = intersect_df.groupby(cluster_columns, sort=False, dropna=False).ngroup().to_numpy()
+        total_observed = int(clusters.max()) + 1 if clusters.shape[0] > 0 else 0
+        if total_clusters is None:
+            total_clusters = total_observed
+        if total_clusters < total_observed:
+            raise ValueError(f"Total clusters {total_clusters} is lower than the {total_observed} clusters observed.")
+        membership = sparse.csr_matrix((np.ones(clusters.shape[0]), (clusters, np.arange(clusters.shape[0]))),
+                                       shape=(total_clusters, clusters.shape[0]))
+        return (membership @ self.difference_matrix(intersect_df, window_size)).tocsr()
+
+    @staticmethod
+    def profile_bins(window_size: int, bin_size: int = 1) -> list[int]:
+        """Edges (relative offsets, the last one exclusive) of the bins of `bin_size` positions.
+
+        Bin k spans [k*b - b//2, k*b - b//2 + b), so that one bin is centred on the origin (for an odd
+        bin size; an even one sits half a position upstream) and the others are laid out symmetrically.
+        The positions left at the window edges that do not fill a whole bin are dropped.
+        """
+        if bin_size < 1:
+            raise ValueError(f"Bin size {bin_size} must be a positive integer.")
+        first = -((window_size - bin_size // 2) // bin_size)
+        last = (window_size - bin_size + 1 + bin_size // 2) // bin_size
+        if first > last:
+            raise ValueError(f"Bin size {bin_size} exceeds the {2 * window_size + 1} window positions.")
+        return [k * bin_size - bin_size // 2 for k in range(first, last + 2)]
+
+    @staticmethod
+    def profile_positions(window_size: int, bin_size: int = 1) -> list[int]:
+        """Relative positions labelling the profile columns; a bin is labelled by its centre (see `profile_bins`)."""
+        return [edge + bin_size // 2 for edge in PWMExtractor.profile_bins(window_size, bin_size)[:-1]]
+
+    @staticmethod
+    def bin_profiles(profiles: np.ndarray, bin_size: int = 1) -> np.ndarray:
+        """Aggregates the positions (last axis) of the profiles into the bins of `profile_bins`."""
+        if bin_size == 1:
+            return profiles
+        window_size = (profiles.shape[-1] - 1) // 2
+        edges = np.asarray(PWMExtractor.profile_bins(window_size, bin_size)) + window_size
+        return np.add.reduceat(profiles[..., edges[0]: edges[-1]], edges[:-1] - edges[0], axis=-1)
+
+    @staticmethod
+    def restrict_window(intersect_df: pd.DataFrame, 
+                        window_size: int, 
+                        max_window_size: int) -> pd.DataFrame:
+        """Trims intersections against windows of `max_window_size` to the nested windows of `window_size`."""
+        if window_size > max_window_size:
+            raise ValueError(f"Window size {window_size} exceeds the window size of the intersection ({max_window_size}).")
+        origin = intersect_df["end"] - max_window_size - 1
+        start = np.maximum(intersect_df["start"], origin - window_size)
+        end = np.minimum(intersect_df["end"], origin + window_size + 1)
+        overlap = np.minimum(intersect_df["motif_end"], end) - np.maximum(intersect_df["motif_start"], start)
+        intersect_df = intersect_df.assign(start=start, end=end, overlap=overlap)
+        return intersect_df[intersect_df["overlap"] > 0]
+
+    def extract_densities(self, intersect_df: pd.DataFrame, 
+                          window_sizes: list[int],
+                          **kwargs) -> dict[int, list[int] | np.ndarray]:
+        """Extracts the density for every window size from one intersection at the largest window size."""
+        max_window_size = max(window_sizes)
+        return {window_size: self.extract_density(self.restrict_window(intersect_df, window_size, max_window_size),
+                                                  window_size=window_size,
+                                                  **kwargs)
+                for window_size in window_sizes}
+
+    def _iterate_density(self, intersect_df: pd.DataFrame, window_size: int) -> tuple[np.ndarray, int]:
         total_counts = np.zeros(2*window_size+1)
         total_overlap = 0
         for _, row in intersect_df.iterrows():
@@ -309,8 +446,24 @@ class PWMExtractor:
             if compartment_strand == "-":
                 temp_counts = temp_counts[::-1]
             total_counts += temp_counts
+        return total_counts, total_overlap
+        
+    def extract_density(self, intersect_df: pd.DataFrame, 
+                        window_size: int,
+                        return_array: bool = True,
+                        return_frame: bool = False,
+                        enrichment: bool = False,
+                        vectorized: bool = True,
+                        bin_size: int = 1,
+                        ) -> list[int] | np.ndarray:
+        if vectorized:
+            L, U, total_overlap = self.relative_offsets(intersect_df, window_size)
+            total_counts = self.accumulate_profiles(L, U, window_size)[0].astype(float)
+        else:
+            total_counts, total_overlap = self._iterate_density(intersect_df, window_size)
         total_sum = int(np.sum(total_counts))
         assert total_overlap == total_sum, f"Overlap: {total_overlap} vs. Calculated overlap {total_sum}."
+        total_counts = self.bin_profiles(total_counts, bin_size=bin_size)
 
         if enrichment:
             total_counts = total_counts / np.mean(total_counts)
@@ -319,19 +472,15 @@ class PWMExtractor:
             name = "Occurrences"
 
         if return_frame:
-            total_counts = pd.Series(total_counts)\
+            total_counts = pd.Series(total_counts, 
+                                     index=self.profile_positions(window_size, bin_size))\
                                 .to_frame(name=name)
-            total_counts.index = total_counts.index - window_size 
             total_counts = total_counts.reset_index()
         elif not return_array:
             total_counts = list(total_counts)
         return total_counts
 
-    def extract_PWM(self, 
-                    intersect_df: pd.DataFrame, 
-                    window_size: int, 
-                    return_frame: bool = True
-                    ) -> dict[str, list[int]]:
+    def _iterate_PWM(self, intersect_df: pd.DataFrame, window_size: int) -> dict[str, list[int]]:
         total_counts = {n: [0 for _ in range(2*window_size+1)] for n in self.nucleotides}
         total_overlap = 0
         for _, row in intersect_df.iterrows():
@@ -369,3 +518,61 @@ class PWMExtractor:
                     total_counts[nucl][index] += 1
         assert total_overlap == sum(sum(v) for v in total_counts.values())
         return total_counts
+
+    def _encode_sequences(self, sequences: pd.Series) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Encodes sequences to nucleotide codes following `self.nucleotides`; unknown bases map to `n`."""
+        lookup = np.full(256, len(self.nucleotides), dtype=np.uint8)
+        for code, nucleotide in enumerate(self.nucleotides):
+            lookup[ord(nucleotide)] = code
+            lookup[ord(nucleotide.upper())] = code
+        lengths = sequences.str.len().to_numpy(dtype=np.int64)
+        buffer = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        return lookup[buffer], offsets, lengths
+
+    def extract_PWM(self, 
+                    intersect_df: pd.DataFrame, 
+                    window_size: int, 
+                    return_frame: bool = True,
+                    vectorized: bool = True,
+                    chunksize: int = 500_000,
+                    ) -> dict[str, list[int]]:
+        if not vectorized:
+            return self._iterate_PWM(intersect_df, window_size)
+        intersect_df = intersect_df[intersect_df["strand"] != "?"]
+        total_nucleotides = len(self.nucleotides)
+        # `n` (or any ambiguous base) is tracked on an extra row to honour the overlap contract
+        complement = np.array([self.nucleotides.index(PWMExtractor.invert(n)) for n in self.nucleotides] + [total_nucleotides],
+                              dtype=np.uint8)
+        total_bins = 2 * window_size + 1
+        total_counts = np.zeros((total_nucleotides + 1) * total_bins, dtype=np.int64)
+        total_overlap = 0
+        for chunk_start in range(0, intersect_df.shape[0], chunksize):
+            chunk = intersect_df.iloc[chunk_start: chunk_start + chunksize]
+            L, U, overlap = self.relative_offsets(chunk, window_size)
+            total_overlap += overlap
+            codes, offsets, lengths = self._encode_sequences(chunk["sequence"])
+            start = chunk["start"].to_numpy(dtype=np.int64)
+            end = chunk["end"].to_numpy(dtype=np.int64)
+            motif_start = chunk["motif_start"].to_numpy(dtype=np.int64)
+            negative = (chunk["strand"] == "-").to_numpy()
+            sequence_start = np.maximum(0, start - motif_start)
+            sequence_end = np.minimum(end - motif_start, lengths)
+            assert np.array_equal(sequence_end - sequence_start, U - L)
+
+            # expand every intersection to its overlapping bases
+            overlap_lengths = U - L
+            row = np.repeat(np.arange(chunk.shape[0]), overlap_lengths)
+            j = np.arange(row.shape[0]) - np.repeat(np.cumsum(overlap_lengths) - overlap_lengths, overlap_lengths)
+            # negative strand: base j of the reverse complement is the complement of base len-1-j
+            # and its mirrored position runs backwards from U-1
+            seq_index = sequence_start[row] + j
+            seq_index = np.where(negative[row], lengths[row] - 1 - seq_index, seq_index)
+            nucleotide = codes[offsets[row] + seq_index]
+            nucleotide = np.where(negative[row], complement[nucleotide], nucleotide)
+            position = np.where(negative[row], U[row] - 1 - j, L[row] + j)
+            total_counts += np.bincount(nucleotide.astype(np.int64) * total_bins + position,
+                                        minlength=total_counts.shape[0])
+        total_counts = total_counts.reshape(total_nucleotides + 1, total_bins)
+        assert total_overlap == int(total_counts.sum()), f"Overlap: {total_overlap} vs. Calculated overlap {int(total_counts.sum())}."
+        return {n: total_counts[code].tolist() for code, n in enumerate(self.nucleotides)}
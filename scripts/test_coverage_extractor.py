@@ -0,0 +1,104 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from coverage_extractor import GFFExtractor
+
+requires_bedtools = pytest.mark.skipif(shutil.which("bedtools") is None, reason="bedtools is not installed")
+
+COVERAGE_COLUMNS = ["seqID", "start", "end", "totalHits", "overlappingBp", "compartmentLength", "coverage"]
+
+
+def random_intervals(seed, n, seqIDs, max_start=400, max_length=60):
+    rng = np.random.default_rng(seed)
+    start = rng.integers(0, max_start, n)
+    return pl.DataFrame({"seqID": rng.choice(seqIDs, n).tolist(),
+                         "start": start,
+                         "end": start + rng.integers(1, max_length, n)})
+
+
+def edge_case_intervals():
+    # touching ends, nested & identical intervals, a hit ending at a start & a chromosome without hits
+    intervals = pl.DataFrame({"seqID": ["chr1", "chr1", "chr1", "chr1", "chr1", "chr2", "chr3"],
+                              "start": [100, 150, 300, 320, 300, 10, 0],
+                              "end": [150, 200, 400, 330, 400, 20, 50]})
+    hits = pl.DataFrame({"seqID": ["chr1", "chr1", "chr1", "chr1", "chr2", "chr2"],
+                         "start": [90, 200, 310, 320, 0, 19],
+                         "end": [100, 210, 390, 330, 10, 25]})
+    return intervals, hits
+
+
+def cases():
+    yield edge_case_intervals()
+    for seed in range(3):
+        yield random_intervals(seed, 60, ["chr1", "chr2", "chr10"], max_length=120), \
+              random_intervals(seed + 100, 150, ["chr1", "chr2", "chrM"], max_length=30)
+
+
+def brute_force_merge(intervals):
+    merged = []
+    for row in intervals.sort(["seqID", "start"]).iter_rows(named=True):
+        if merged and merged[-1][0] == row["seqID"] and row["start"] <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], row["end"])
+            merged[-1][3] += 1
+        else:
+            merged.append([row["seqID"], row["start"], row["end"], 1])
+    return pd.DataFrame(merged, columns=["seqID", "start", "end", "counts"])
+
+
+def brute_force_coverage(intervals, hits):
+    rows = []
+    for row in intervals.iter_rows(named=True):
+        overlapping = [hit for hit in hits.iter_rows(named=True)
+                       if hit["seqID"] == row["seqID"] and hit["start"] < row["end"] and row["start"] < hit["end"]]
+        covered = set()
+        for hit in overlapping:
+            covered.update(range(max(row["start"], hit["start"]), min(row["end"], hit["end"])))
+        length = row["end"] - row["start"]
+        rows.append((row["seqID"], row["start"], row["end"], len(overlapping), len(covered), length, len(covered) / length))
+    return pd.DataFrame(rows, columns=COVERAGE_COLUMNS)
+
+
+def canonical(df, columns):
+    return df[columns].sort_values(columns).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("intervals, hits", list(cases()))
+def test_merge_intervals_matches_brute_force(intervals, hits):
+    merged = GFFExtractor.merge_intervals(intervals).to_pandas()
+    columns = ["seqID", "start", "end", "counts"]
+    pd.testing.assert_frame_equal(canonical(merged, columns), canonical(brute_force_merge(intervals), columns), check_dtype=False)
+
+
+@pytest.mark.parametrize("intervals, hits", list(cases()))
+def test_interval_coverage_matches_brute_force(intervals, hits):
+    coverage = GFFExtractor.interval_coverage(intervals, hits).to_pandas()
+    pd.testing.assert_frame_equal(canonical(coverage, COVERAGE_COLUMNS),
+                                  canonical(brute_force_coverage(intervals, hits), COVERAGE_COLUMNS),
+                                  check_dtype=False)
+
+
+@requires_bedtools
+@pytest.mark.parametrize("intervals, hits", list(cases()))
+def test_merge_intervals_matches_bedtools(intervals, hits):
+    pybedtools = pytest.importorskip("pybedtools")
+    columns = ["seqID", "start", "end", "counts"]
+    merged_bed = pybedtools.BedTool.from_dataframe(intervals.to_pandas()).sort().merge(c="3", o="count")
+    reference = pd.read_table(merged_bed.fn, header=None, names=columns)
+    merged = GFFExtractor.merge_intervals(intervals).to_pandas()
+    pd.testing.assert_frame_equal(canonical(merged, columns), canonical(reference, columns), check_dtype=False)
+
+
+@requires_bedtools
+@pytest.mark.parametrize("intervals, hits", list(cases()))
+def test_interval_coverage_matches_bedtools(intervals, hits):
+    pybedtools = pytest.importorskip("pybedtools")
+    coverage_bed = pybedtools.BedTool.from_dataframe(intervals.to_pandas()).sort()\
+                        .coverage(pybedtools.BedTool.from_dataframe(hits.to_pandas()).sort())
+    reference = pd.read_table(coverage_bed.fn, header=None, names=COVERAGE_COLUMNS)
+    coverage = GFFExtractor.interval_coverage(intervals, hits).to_pandas()
+    pd.testing.assert_frame_equal(canonical(coverage, COVERAGE_COLUMNS), canonical(reference, COVERAGE_COLUMNS),
+                                  check_dtype=False, atol=1e-6)
@@ -0,0 +1,71 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from density import intersect, intersect_bedtools
+
+requires_bedtools = pytest.mark.skipif(shutil.which("bedtools") is None, reason="bedtools is not installed")
+
+INTERSECT_COLUMNS = ["seqID", "start", "end", "strand", "chrom", "motif_start", "motif_end", "motif_strand", "overlap"]
+
+
+def random_intervals(rng, n, seqIDs, max_start=400, max_length=60):
+    start = rng.integers(0, max_start, n)
+    return pd.DataFrame({"seqID": rng.choice(seqIDs, n),
+                         "start": start,
+                         "end": start + rng.integers(1, max_length, n)})
+
+
+def edge_case_intervals():
+    # zero overlap, touching ends on both sides, nested & identical intervals and a chromosome without motifs
+    A_df = pd.DataFrame({"seqID": ["chr1", "chr1", "chr1", "chr1", "chr2", "chr3"],
+                         "start": [100, 200, 300, 500, 10, 0],
+                         "end": [150, 250, 400, 510, 20, 50],
+                         "strand": ["+", "-", "+", "-", "+", "-"]})
+    B_df = pd.DataFrame({"seqID": ["chr1", "chr1", "chr1", "chr1", "chr1", "chr2", "chr2"],
+                         "start": [150, 180, 320, 300, 500, 0, 10],
+                         "end": [160, 200, 330, 400, 510, 10, 20],
+                         "motif_strand": ["+", "-", "+", "-", "+", "-", "+"]})
+    return A_df, B_df
+
+
+def random_case(seed):
+    rng = np.random.default_rng(seed)
+    A_df = random_intervals(rng, 80, ["chr1", "chr2", "chr10"], max_length=120)
+    A_df["strand"] = rng.choice(["+", "-"], A_df.shape[0])
+    B_df = random_intervals(rng, 150, ["chr1", "chr2", "chrM"], max_length=30)
+    B_df["motif_strand"] = rng.choice(["+", "-"], B_df.shape[0])
+    return A_df, B_df
+
+
+def brute_force_intersect(A_df, B_df):
+    rows = []
+    for a in A_df.itertuples(index=False):
+        hits = [(b.seqID, b.start, b.end, b.motif_strand, min(a.end, b.end) - max(a.start, b.start))
+                for b in B_df.itertuples(index=False)
+                if b.seqID == a.seqID and b.start < a.end and a.start < b.end]
+        for hit in hits or [(".", -1, -1, ".", 0)]:
+            rows.append((a.seqID, a.start, a.end, a.strand) + hit)
+    return pd.DataFrame(rows, columns=INTERSECT_COLUMNS)
+
+
+def canonical(intersect_df):
+    # bedtools and the numpy sweep may list the motifs of a target in a different order
+    intersect_df = intersect_df[INTERSECT_COLUMNS].astype(str)
+    return intersect_df.sort_values(INTERSECT_COLUMNS).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("case", ["edges", 0, 1, 2])
+def test_intersect_matches_brute_force(case):
+    A_df, B_df = edge_case_intervals() if case == "edges" else random_case(case)
+    pd.testing.assert_frame_equal(canonical(intersect(A_df, B_df)), canonical(brute_force_intersect(A_df, B_df)))
+
+
+@requires_bedtools
+@pytest.mark.parametrize("case", ["edges", 0, 1, 2])
+def test_intersect_matches_bedtools(case):
+    A_df, B_df = edge_case_intervals() if case == "edges" else random_case(case)
+    intersect_df, _, _ = intersect_bedtools(A_df, B_df)
+    pd.testing.assert_frame_equal(canonical(intersect(A_df, B_df)), canonical(intersect_df))
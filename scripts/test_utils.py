@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from utils import write_enrichment_bucket, read_bucket_batches, stream_enrichment_buckets
+
+
+@pytest.mark.parametrize("count", [127, 128, 32_767, 32_768, 2**31 - 1, 2**31])
+def test_enrichment_bucket_round_trip(tmp_path, count):
+    enrichment_df = pd.DataFrame({"#assembly_accession": ["GCF_1", "GCF_2"],
+                                  "site": ["tss", "tes"],
+                                  "biotype": [".", "."],
+                                  "partition": ["all", 0],
+                                  "-1": [count, np.nan],
+                                  "0": [0.0, count],
+                                  "1": [1.0, 2.0]}).set_index("#assembly_accession")
+    bucket = tmp_path / "bucket.enrichment.arrow"
+    write_enrichment_bucket(enrichment_df, bucket)
+    table = pd.concat([batch.to_pandas() for batch in read_bucket_batches(bucket)])
+    assert table["-1"].tolist()[0] == count and np.isnan(table["-1"].tolist()[1])
+    assert table["0"].tolist() == [0.0, count]
+    assert table["partition"].tolist() == ["all", "0"]
+
+
+def test_enrichment_bucket_count_types(tmp_path):
+    buckets = []
+    for bucket_id, counts in enumerate([[0, 255], [-1, 300], [0, 2**40]]):
+        enrichment_df = pd.DataFrame({"#assembly_accession": [f"GCF_{bucket_id}"] * 2,
+                                      "site": ["tss", "tss"],
+                                      "biotype": [".", "."],
+                                      "partition": ["all", "all"],
+                                      "0": counts,
+                                      "1": [0.5, 1.0]}).set_index("#assembly_accession")
+        buckets.append(tmp_path / f"bucket_{bucket_id}.enrichment.arrow")
+        write_enrichment_bucket(enrichment_df, buckets[-1])
+    types = [next(read_bucket_batches(bucket)).schema.field("0").type for bucket in buckets]
+    assert types == [pa.uint8(), pa.int16(), pa.int64()]
+    stream_enrichment_buckets(buckets, {"TSS": tmp_path / "TSS.parquet"})
+    reduced = pd.read_parquet(tmp_path / "TSS.parquet")
+    assert reduced["0"].dtype == np.float64 and reduced["1"].dtype == np.float64
+    assert reduced["0"].tolist() == [0, 255, -1, 300, 0, 2**40]
@@ -1,12 +1,22 @@
 from Bio import SeqIO
 import time
 import gzip
+import heapq
 import json
 import os
+import shutil
 from pathlib import Path
 import threading
 import logging
-from typing import Optional
+from typing import Optional, Iterator
+import numpy as np
+import pandas as pd
+import csv
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 
 INTERSECT_FIELDS = ["seqID",
                     "start",
@@ -68,3 +78,334 @@ def parse_fasta(accession: os.PathLike[str]) -> tuple[str]:
 def load_bucket(bucket_id: int, schedule_path: os.PathLike[str]) -> list[str]:
     with open(schedule_path, mode="r", encoding="UTF-8") as f:
         return json.load(f)[str(bucket_id)]
+
+class BucketCheckpoint:
+    """Per-accession part files of a bucket output, next to `<output>.parts/manifest.json`.
+
+    Every finished accession is written as Arrow IPC parts (one per named table) before the
+    manifest records it, so a restarted job skips it. Parts written under a different
+    `signature` (the run parameters) are discarded.
+    """
+
+    def __init__(self, output: os.PathLike[str], signature: Optional[dict] = None) -> None:
+        self.directory = Path(f"{output}.parts").resolve()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_file = self.directory.joinpath("manifest.json")
+        self.signature = json.loads(json.dumps(signature or {}, default=str))
+        self.parts = {}
+        if self.manifest_file.is_file():
+            with open(self.manifest_file, mode="r", encoding="UTF-8") as f:
+                manifest = json.load(f)
+            if manifest.get("signature") == self.signature:
+                self.parts = manifest["parts"]
+            else:
+                logging.info(f"Discarding checkpoint `{self.directory}` of a run with different parameters.")
+        if self.parts:
+            logging.info(f"Resuming from checkpoint `{self.directory}` with {len(self.parts)} finished accessions.")
+
+    def done(self, key: str) -> bool:
+        return key in self.parts
+
+    def save(self, key: str, tables: dict[str, Optional[pa.Table | pd.DataFrame]]) -> None:
+        """Records the tables of a finished accession; `None` marks an accession without results."""
+        part = {}
+        for name, table in tables.items():
+            if table is None:
+                part[name] = None
+                continue
+            if isinstance(table, pd.DataFrame):
+                # mixed object columns (e.g. `all` & integer partitions) are kept as their text
+                table = table.copy()
+                for column in table.columns[table.dtypes == object]:
+                    table[column] = table[column].astype(str).where(table[column].notna(), None)
+                table = pa.Table.from_pandas(table, preserve_index=False)
+            filename = f"{len(self.parts):06d}.{name}.arrow"
+            temp_file = self.directory.joinpath(f"{filename}.tmp")
+            with pa.ipc.new_file(temp_file, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(temp_file, self.directory.joinpath(filename))
+            part[name] = filename
+        self.parts[key] = part
+        temp_manifest = self.directory.joinpath("manifest.json.tmp")
+        with open(temp_manifest, mode="w", encoding="UTF-8") as f:
+            json.dump({"signature": self.signature, "parts": self.parts}, f)
+        os.replace(temp_manifest, self.manifest_file)
+
+    def load(self, name: str, keys: list[str]) -> list[pa.Table]:
+        """Memory-mapped `name` tables of the finished `keys`, in the order of `keys`."""
+        tables = []
+        for key in keys:
+            filename = self.parts.get(key, {}).get(name)
+            if filename is not None:
+                tables.append(pa.ipc.open_file(pa.memory_map(str(self.directory.joinpath(filename)), "r")).read_all())
+        return tables
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+COUNT_TYPES = [pa.uint8(), pa.int8(), pa.uint16(), pa.int16(), pa.uint32(), pa.int32(), pa.int64()]
+
+def count_type(counts: np.ndarray) -> Optional[pa.DataType]:
+    """Narrowest integer type holding every count, None for fractional values or counts beyond int64."""
+    if not np.array_equal(counts, np.round(counts)):
+        return None
+    low, high = counts.min(initial=0), counts.max(initial=0)
+    for candidate in COUNT_TYPES:
+        limits = np.iinfo(candidate.to_pandas_dtype())
+        if limits.min <= low and high <= limits.max:
+            return candidate
+    return None
+
+def write_enrichment_bucket(enrichment_df: pd.DataFrame,
+                            output: os.PathLike[str],
+                            compression: Optional[str] = "zstd",
+                            max_chunksize: int = 10_000) -> None:
+    """Writes a bucket profile table as a (zstd-compressed) Arrow IPC file of record batches of at most
+    `max_chunksize` rows, the blocks of the reduce step; `compression=None` writes a file that is
+    memory-mapped without decompression.
+
+    Every profile column is stored as the narrowest integer type holding its counts (null outside of a
+    smaller window); normalized profiles stay float64. The key columns (accession, site, biotype,
+    partition, template flag) are dictionary-encoded.
+    """
+    enrichment_df = enrichment_df.reset_index() if enrichment_df.index.name else enrichment_df
+    arrays, names = [], []
+    for column in enrichment_df.columns:
+        values = enrichment_df[column]
+        if str(column).lstrip("-").isdigit():
+            values = values.to_numpy(dtype=float)
+            missing = np.isnan(values)
+            counts = np.where(missing, 0, values)
+            profile_type = count_type(counts)
+            if profile_type is not None:
+                array = pa.array(counts.astype(profile_type.to_pandas_dtype()), mask=missing, type=profile_type)
+            else:
+                array = pa.array(values, type=pa.float64(), from_pandas=True)
+        elif column == "window_size":
+            array = pa.array(values.to_numpy(dtype=np.int64), type=pa.int64())
+        else:
+            array = pa.array(values.astype(str).where(values.notna(), None), type=pa.string()).dictionary_encode()
+        arrays.append(array)
+        names.append(str(column))
+    table = pa.Table.from_arrays(arrays, names=names)
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_file(output, table.schema, options=options) as writer:
+        writer.write_table(table, max_chunksize=max_chunksize)
+
+def _decode_bucket_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """Decodes the dictionary columns, whose dictionaries differ across buckets; the integer counts are kept as they are."""
+    columns = [column.dictionary_decode() if pa.types.is_dictionary(column.type) else column for column in batch.columns]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+def read_bucket_batches(bucket_file: os.PathLike[str], block_size: int = 1 << 26) -> Iterator[pa.RecordBatch]:
+    """Record batches of an enrichment bucket; Arrow buckets are memory-mapped, CSV buckets are parsed in typed blocks."""
+    if str(bucket_file).endswith(".arrow"):
+        with pa.memory_map(str(bucket_file), "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield _decode_bucket_batch(reader.get_batch(i))
+        return
+    reader = pv.open_csv(bucket_file,
+                         read_options=pv.ReadOptions(block_size=block_size),
+                         convert_options=pv.ConvertOptions(column_types=bucket_column_types(bucket_file), strings_can_be_null=True))
+    yield from reader
+
+def bucket_schema(bucket_file: os.PathLike[str]) -> pa.Schema:
+    if str(bucket_file).endswith(".arrow"):
+        with pa.memory_map(str(bucket_file), "r") as source:
+            schema = pa.ipc.open_file(source).schema
+        return pa.schema([(field.name, field.type.value_type) if pa.types.is_dictionary(field.type) else (field.name, field.type)
+                          for field in schema])
+    return pa.schema(list(bucket_column_types(bucket_file).items()))
+
+def bucket_column_types(bucket_file: os.PathLike[str]) -> dict[str, pa.DataType]:
+    """Typed schema of an enrichment bucket: float profile positions, integer window sizes & string keys."""
+    with open(bucket_file, mode="r", encoding="UTF-8") as f:
+        header = next(csv.reader(f), [])
+    column_types = {}
+    for column in header:
+        if column.lstrip("-").isdigit():
+            column_types[column] = pa.float64()
+        elif column == "window_size":
+            column_types[column] = pa.int64()
+        else:
+            column_types[column] = pa.string()
+    return column_types
+
+TAXONOMY_ORDER = "_taxonomy_order"
+
+def taxonomy_order(taxonomy: pa.Table, taxonomic_ranks: list[str]) -> tuple[pa.Array, int]:
+    """Position of every design row in the (stable, missing ranks last) ordering of the taxonomy.
+
+    Also returns the position of accessions missing from the design, whose ranks are all null.
+    """
+    keys = taxonomy.select(taxonomic_ranks).to_pandas()
+    keys = pd.concat([keys, pd.DataFrame([[None] * len(taxonomic_ranks)], columns=taxonomic_ranks)], ignore_index=True)
+    codes = keys.groupby(taxonomic_ranks, sort=True, dropna=False).ngroup().to_numpy(dtype=np.int64)
+    return pa.array(codes[:-1]), int(codes[-1])
+
+def _row_groups(batches: Iterator[pa.RecordBatch], row_group_size: int) -> Iterator[pa.Table]:
+    """Regroups a stream of record batches into tables of `row_group_size` rows (the last one may be shorter)."""
+    pending, total_pending = [], 0
+    for batch in batches:
+        pending.append(batch)
+        total_pending += batch.num_rows
+        if total_pending >= row_group_size:
+            table = pa.Table.from_batches(pending)
+            while table.num_rows >= row_group_size:
+                yield table.slice(0, row_group_size)
+                table = table.slice(row_group_size)
+            pending, total_pending = table.to_batches(), table.num_rows
+    if total_pending > 0:
+        yield pa.Table.from_batches(pending)
+
+def _merge_sorted_runs(reader: pa.ipc.RecordBatchFileReader, runs: list[tuple[int, int]]) -> Iterator[pa.RecordBatch]:
+    """K-way merges the runs (batch ranges of `reader`, each sorted on `TAXONOMY_ORDER`) into a sorted stream of batches.
+
+    The run with the smallest (key, run) head is drained up to the head of the next run, so that
+    rows sharing a key are written one run at a time in run order: the merge equals a stable sort
+    of the concatenated runs while holding a single batch per run.
+    """
+    next_batch = [start for start, _ in runs]
+    buffers = [None] * len(runs)
+
+    def load(i: int) -> bool:
+        while next_batch[i] < runs[i][1]:
+            batch = reader.get_batch(next_batch[i])
+            next_batch[i] += 1
+            if batch.num_rows > 0:
+                buffers[i] = batch
+                return True
+        buffers[i] = None
+        return False
+
+    heap = [(buffers[i][TAXONOMY_ORDER][0].as_py(), i) for i in range(len(runs)) if load(i)]
+    heapq.heapify(heap)
+    while heap:
+        _, i = heapq.heappop(heap)
+        buffer = buffers[i]
+        if heap:
+            # rows up to the next head; tied rows of an earlier run go first
+            next_key, next_run = heap[0]
+            cut = int(np.searchsorted(buffer[TAXONOMY_ORDER].to_numpy(), next_key, side="right" if i < next_run else "left"))
+        else:
+            cut = buffer.num_rows
+        yield buffer.slice(0, cut)
+        if cut < buffer.num_rows:
+            buffers[i] = buffer.slice(cut)
+            heapq.heappush(heap, (buffers[i][TAXONOMY_ORDER][0].as_py(), i))
+        elif load(i):
+            heapq.heappush(heap, (buffers[i][TAXONOMY_ORDER][0].as_py(), i))
+
+def stream_enrichment_buckets(bucket_files: list[os.PathLike[str]],
+                              outputs: dict[str, os.PathLike[str]],
+                              design: Optional[os.PathLike[str]] = None,
+                              taxonomic_ranks: Optional[list[str]] = None,
+                              metadata: Optional[dict[str, str]] = None,
+                              row_group_size: int = 10_000,
+                              block_size: int = 1 << 26,
+                              tempdir: Optional[os.PathLike[str]] = None) -> None:
+    """Reduces the enrichment buckets into one parquet file per site ({site: output}).
+
+    CSV buckets are parsed in typed blocks of `block_size` bytes and Arrow buckets are memory-mapped
+    batch by batch; every block is joined with the design taxonomy, split by site, ordered on the
+    taxonomy and spilled as a sorted Arrow run. The runs of a site are then k-way merged into row
+    groups of `row_group_size` rows carrying min/max statistics. Memory is bounded by a parsed block
+    plus a spilled batch per run, not by a bucket or the reduced table.
+    """
+    if taxonomic_ranks is None:
+        taxonomic_ranks = ["superkingdom", "kingdom", "phylum"]
+    taxonomy = None
+    if design is not None:
+        with open(design, mode="r", encoding="UTF-8") as f:
+            design_columns = next(csv.reader(f), [])
+        taxonomic_ranks = [rank for rank in taxonomic_ranks if rank in design_columns]
+        taxonomy = pv.read_csv(design,
+                               convert_options=pv.ConvertOptions(include_columns=["accession_id"] + taxonomic_ranks,
+                                                                 column_types={column: pa.string() for column in ["accession_id"] + taxonomic_ranks},
+                                                                 strings_can_be_null=True))
+        order_codes, missing_code = taxonomy_order(taxonomy, taxonomic_ranks)
+    else:
+        taxonomic_ranks = []
+    schema_metadata = {key.encode(): str(value).encode() for key, value in (metadata or {}).items()}
+
+    # integer counts of differently typed buckets are widened to a common type, and to float64 in the output only
+    bucket_types = pa.unify_schemas([bucket_schema(bucket_file) for bucket_file in bucket_files], promote_options="permissive")\
+                        if bucket_files else pa.schema([])
+
+    with tempfile.TemporaryDirectory(dir=tempdir) as spill_dir:
+        # one spill file per site; every block adds a sorted run, i.e. a range of its record batches
+        spill_files = {site: Path(spill_dir, f"{site}.arrow") for site in outputs}
+        writers, runs = {}, {site: [] for site in outputs}
+        schema = None
+        for bucket_file in bucket_files:
+            for batch in read_bucket_batches(bucket_file, block_size=block_size):
+                if batch.num_rows == 0:
+                    continue
+                table = pa.Table.from_batches([batch])
+                if taxonomy is not None:
+                    # first design entry of every accession; missing accessions get null ranks
+                    rows = pc.index_in(table["#assembly_accession"], value_set=taxonomy["accession_id"])
+                    for rank in taxonomic_ranks:
+                        table = table.append_column(rank, taxonomy[rank].take(rows))
+                    table = table.append_column(TAXONOMY_ORDER, pc.fill_null(order_codes.take(rows), missing_code))
+                if schema is None:
+                    schema = pa.schema([bucket_types.field(field.name) if field.name in bucket_types.names else field
+                                        for field in table.drop_columns(["site"]).schema])
+                    writers = {site: pa.ipc.new_file(spill_file, schema) for site, spill_file in spill_files.items()}
+                for site in outputs:
+                    site_table = table.filter(pc.equal(table["site"], site.lower())).drop_columns(["site"])
+                    if site_table.num_rows == 0:
+                        continue
+                    site_table = site_table.select(schema.names).cast(schema)
+                    if taxonomy is not None:
+                        # stable, so ties keep the block order
+                        site_table = site_table.take(pc.sort_indices(site_table, sort_keys=[(TAXONOMY_ORDER, "ascending")]))
+                    start = runs[site][-1][1] if runs[site] else 0
+                    site_batches = site_table.combine_chunks().to_batches(max_chunksize=row_group_size)
+                    for site_batch in site_batches:
+                        writers[site].write_batch(site_batch)
+                    runs[site].append((start, start + len(site_batches)))
+        for writer in writers.values():
+            writer.close()
+
+        if schema is None:
+            # no profiles in any bucket; keep the columns of the first bucket
+            fields = [field for field in bucket_schema(bucket_files[0]) if field.name != "site"] if bucket_files else []
+            schema = pa.schema(fields + [(rank, pa.string()) for rank in taxonomic_ranks])
+        output_schema = pa.schema([(field.name, pa.float64()) if field.name.lstrip("-").isdigit() else field
+                                   for field in schema if field.name != TAXONOMY_ORDER], metadata=schema_metadata)
+        for site, output in outputs.items():
+            with pq.ParquetWriter(output, output_schema, write_statistics=True) as writer:
+                if not runs[site]:
+                    writer.write_table(output_schema.empty_table())
+                    continue
+                with pa.memory_map(str(spill_files[site]), "r") as source:
+                    reader = pa.ipc.open_file(source)
+                    if taxonomy is not None:
+                        # ordered on the taxonomy (missing ranks last), so that rank-sliced reads only touch a few row groups
+                        batches = _merge_sorted_runs(reader, runs[site])
+                    else:
+                        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+                    for row_group in _row_groups(batches, row_group_size):
+                        row_group = row_group.select(output_schema.names).cast(output_schema)
+                        writer.write_table(row_group, row_group_size=row_group_size)
+
+
+def stream_query_buckets(bucket_files: list[os.PathLike[str]], outputs: dict[str, os.PathLike[str]]) -> None:
+    """Reduces the query buckets into one CSV per site ({site: output}), reading a single bucket at a time."""
+    columns = []
+    for bucket_file in bucket_files:
+        with open(bucket_file, mode="r", encoding="UTF-8") as f:
+            columns.extend(column for column in next(csv.reader(f), []) if column not in columns)
+    if "#assembly_accession" in columns:
+        columns = ["#assembly_accession"] + [column for column in columns if column != "#assembly_accession"]
+    site_columns = [column for column in columns if column != "site"]
+    for output in outputs.values():
+        pd.DataFrame([], columns=site_columns).to_csv(output, sep=",", index=False, mode="w")
+    for bucket_file in bucket_files:
+        queries_df = pd.read_csv(bucket_file).reindex(columns=columns)
+        for site, output in outputs.items():
+            site_df = queries_df[queries_df["site"] == site.lower()].drop(columns=["site"])
+            if not site_df.empty:
+                site_df.to_csv(output, sep=",", index=False, header=False, mode="a")